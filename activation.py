@@ -0,0 +1,85 @@
+import pygame
+
+import options
+import collisions
+
+class ActivationScheduler:
+    """Decides which of a level's active entities are updated each frame, and with what dt, based on
+       where they are relative to the player. Inside the near region (what's onscreen plus a margin)
+       everything is updated every frame. Enemies in the far region are updated every far_interval
+       frames with all the dt they've missed, and enemies beyond it are frozen. Moving blocks outside 
+       the near region aren't updated at all, and their v is zeroed so they act like static blocks. A 
+       path's position only depends on its t, so when one of them comes back into range it's jumped 
+       ahead by the time it missed in one step, and anything that was riding it is dropped and woken 
+       up. Everything here depends only on positions and frame counts, so it's deterministic."""
+
+    def __init__(self, near_size=None, far_size=None, far_interval=4, sleep_fixer=None):
+        screen_w, screen_h = options.standard_size()
+        self.near_size = near_size if near_size != None else (2*screen_w, 2*screen_h)
+        self.far_size = far_size if far_size != None else (4*screen_w, 4*screen_h)
+        self.far_interval = far_interval
+        self.sleep_fixer = sleep_fixer if sleep_fixer != None else collisions.SleepFixer()
+        self._level = None
+        self._frame = 0
+        self._pending = {}      # entity -> the dt it has missed
+        self._phases = {}       # far enemy -> which frame out of every far_interval it's updated on
+        self._next_phase = 0
+
+    def schedule(self, level, entities, player, dt):
+        """Returns (updates, skipped), where updates is a list of (entity, dt) pairs for the entities
+           that should be updated this frame, in the same order as entities, and skipped is how many 
+           entities were left out."""
+        if level is not self._level:
+            self._level = level
+            self._frame = 0
+            self._pending = {}
+            self._phases = {}
+            self._next_phase = 0
+        self._frame += 1
+
+        near = pygame.Rect((0, 0), self.near_size)
+        near.center = player.rect.center
+        far = pygame.Rect((0, 0), self.far_size)
+        far.center = player.rect.center
+
+        result = []
+        pending = {}
+        phases = {}
+        for item in entities:
+            kind = item.update_kind()
+            if kind == "enemy":
+                missed = self._pending.get(item, 0) + dt
+                if near.colliderect(item.rect):
+                    result.append((item, missed))
+                elif far.colliderect(item.rect):
+                    if item in self._phases:
+                        phases[item] = self._phases[item]
+                    else:
+                        phases[item] = self._next_phase % self.far_interval
+                        self._next_phase += 1
+                    if (self._frame + phases[item]) % self.far_interval == 0:
+                        result.append((item, missed))
+                    else:
+                        pending[item] = missed
+            elif kind == "moving_block":
+                missed = self._pending.get(item, 0)
+                path = item.get_path()
+                if missed > 0:
+                    xy = path.get_xy(path.t + missed)     # where it would be now
+                    rect = item.rect.move(item.x_initial() + xy[0] - item.x(), item.y_initial() + xy[1] - item.y())
+                else:
+                    rect = item.rect
+                if near.colliderect(rect):
+                    if missed > 0:
+                        for kid in item.skip_ahead(missed):
+                            if kid.is_sleeping:
+                                self.sleep_fixer.wake(kid, level.sleep_grid)
+                    result.append((item, dt))
+                else:
+                    pending[item] = missed + dt
+                    item.v = (0, 0)     # so it acts like a static block to anything still touching it
+            else:
+                result.append((item, dt))
+        self._pending = pending
+        self._phases = phases
+        return (result, len(entities) - len(result))
@@ -7,10 +7,22 @@ import blocks
 import options
 
 class Actor(blocks.Box):
+    __slots__ = ("wall_stick_time", "jumps", "jump_buffer", "wall_release_time", "ground_friction", "air_friction", 
+            "is_player", "finished_level", "jump_speed", "move_speed", "air_move_speed")
     STANDARD_SIZE = (24, 32)
     
+    is_grounded             = blocks.flag_property(blocks.FLAG_GROUNDED)
+    is_left_walled          = blocks.flag_property(blocks.FLAG_LEFT_WALLED)
+    is_right_walled         = blocks.flag_property(blocks.FLAG_RIGHT_WALLED)
+    is_left_toe_grounded    = blocks.flag_property(blocks.FLAG_LEFT_TOE)
+    is_right_toe_grounded   = blocks.flag_property(blocks.FLAG_RIGHT_TOE)
+    is_crushed              = blocks.flag_property(blocks.FLAG_CRUSHED)
+    is_alive                = blocks.alive_property()
+    
     def __init__(self, width=24, height=32, color=(255, 128, 128)):
         blocks.Box.__init__(self, width, height, color)
+        self.collision_layer = blocks.LAYER_PLAYER
+        
         # Actor collision state variables.
         # Note: these are reset to false on each actor update, and reapplied by the collision fixer.
         self.is_grounded = False        # is touching a solid box that's below
@@ -51,6 +63,7 @@ class Actor(blocks.Box):
         self.finished_level = False
         self.v = (0, 0)
         self.a = (0, 0.3)
+        self.moved_from = None
         
     def kill(self, message="unknown causes."):
         self.is_alive = False
@@ -102,20 +115,15 @@ class Actor(blocks.Box):
             else:
                 self.set_vx(self.vx() + dir*self.air_move_speed)
         
-    def update(self, dt):
+    def update_before_physics(self, dt):
         if not self.is_right_walled and not self.is_left_walled:
             self.wall_stick_time = 0
         if not self.is_grounded:    # if player has left ground, there shouldn't be any horizontal acceleration
             self.set_ax(0)
         
-        self.is_grounded = False
-        self.is_left_walled = False
-        self.is_right_walled = False
-        self.is_left_toe_grounded = False
-        self.is_right_toe_grounded = False
-        
-        blocks.Box.update(self, dt)
+        self._flags &= ~blocks.FLAG_CONTACTS
         
+    def update_after_physics(self, dt):
         #fall detection
         if self.y() >= 1024:
             self.kill("falling too far.")
@@ -144,6 +152,16 @@ class Actor(blocks.Box):
     def get_update_priority(self):
         return 1
         
+    def can_sleep(self):
+        return not self.is_player and blocks.Box.can_sleep(self)
+        
+    def rest_state(self):
+        return blocks.Box.rest_state(self) + (self.is_alive, self.is_crushed, self.is_grounded, self.is_left_walled, 
+                self.is_right_walled, self.is_left_toe_grounded, self.is_right_toe_grounded)
+        
+    def update_kind(self):
+        return "actor"
+        
     def is_actor(self): return True
         
     def __repr__(self):
@@ -154,12 +172,14 @@ class Actor(blocks.Box):
         
         
 class Enemy(Actor):
+    __slots__ = ("direction", "walks_off_platforms", "is_stompable")
     NORMAL_COLOR = (255, 0, 255)
     SMART_COLOR = (0, 125, 125)
     BAD_COLOR = (255, 0, 0)
     
     def __init__(self, width, height, color=(255, 0, 255)):
         Actor.__init__(self, width, height, color)
+        self.collision_layer = blocks.LAYER_ENEMY
         self.max_vx = 1
         self.move_speed = 0.5
         self.direction = -1
@@ -167,13 +187,21 @@ class Enemy(Actor):
         self.walks_off_platforms = True
         self.is_stompable = True
         
-    def update(self, dt):
+    def update_before_physics(self, dt):
         if not self.is_alive:
             return;
         if not self.walks_off_platforms and self.is_grounded:
             if (self.direction == -1 and not self.is_left_toe_grounded) or (self.direction == 1 and not self.is_right_toe_grounded):
                 self.direction = -1*self.direction
-        Actor.update(self, dt)
+        Actor.update_before_physics(self, dt)
+        
+    def uses_physics(self):
+        return self.is_alive and Actor.uses_physics(self)
+        
+    def update_after_physics(self, dt):
+        if not self.is_alive:
+            return;
+        Actor.update_after_physics(self, dt)
         
         self.move_action(self.direction)
         
@@ -197,6 +225,9 @@ class Enemy(Actor):
         elif obj.is_solid and (dir == "RIGHT" or dir == "LEFT"):
             self.direction = -self.direction
             
+    def update_kind(self):
+        return "enemy"
+        
     def is_enemy(self): return True    
          
     def to_json(self):
@@ -244,26 +275,41 @@ class GhostRecorder:
         self.y_points = []
 
 class Ghost(Actor):
+    __slots__ = ("x_points", "y_points", "index")
+    
     def __init__(self, x_points, y_points, color):
         Actor.__init__(self)
         self.is_solid = False
+        self.collision_mask = 0
         self.set_color(color)
         self.x_points = x_points
         self.y_points = y_points
         self.index = 0
 
-    def update(self, dt):
+    def update_before_physics(self, dt):
         self.index += 1
         if self.index >= len(self.x_points):
             self.is_alive = False
         else:
             self.set_x(self.x_points[self.index])
             self.set_y(self.y_points[self.index])
+            
+    def uses_physics(self):
+        return False
+        
+    def update_after_physics(self, dt):
+        pass
     
     def reset(self):
         self.is_alive = True
         self.index = 0
         
+    def can_sleep(self):
+        return False
+        
+    def update_kind(self):
+        return "ghost"
+        
     def is_ghost(self):
         return True
     
@@ -290,36 +336,9 @@ class Ghost(Actor):
                 "color":[c[0], c[1], c[2]]
             }
             
-class Particle(blocks.Box):
-    def __init__(self, x, y, size, v, color, lifespan=100):
-        blocks.Box.__init__(self, size, size)
-        
-        self.set_xy(x, y)
-        self.set_vx(v[0])
-        self.set_vy(v[1])
-        self.is_solid = True
-        self.has_physics = True
-        self.is_visible = True
-        self.is_pushable = True
-        self.is_alive = True
-        self.color = color
-        self.lifespan = lifespan
-        
-    def update(self, dt):
-        blocks.Box.update(self, dt)
-        self.lifespan -= dt
-        if self.lifespan <= 0:
-            self.is_alive = False
-        else:
-            # hacked in some friction
-            if abs(self.vy()) < 1:
-                self.set_vx(self.vx()*0.95)
-            
-    def is_particle(self):
-        return True
-        
-
 class SpawnPoint(blocks.Box):
+    __slots__ = ("actor",)
+    
     def __init__(self, x, y, actor):
         blocks.Box.__init__(self, 10, 10)
         self.set_xy(x, y)
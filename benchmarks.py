@@ -0,0 +1,231 @@
+"""Micro benchmarks for the engine. Run with: python benchmarks.py [name ...]
+   Each benchmark prints its results, so runs on different commits can be compared."""
+import gc
+import glob
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import pygame
+
+import blocks
+import actors
+import drawing
+import math_parser
+import particles
+import spatial
+
+def make_entities(n, seed=1234):
+    "a synthetic level of n entities, mostly blocks with some enemies"
+    rng = random.Random(seed)
+    result = []
+    for i in range(n):
+        x = rng.randint(0, 20000)
+        y = rng.randint(0, 2000)
+        kind = rng.random()
+        if kind < 0.7:
+            result.append(blocks.Block(x, y, 16*rng.randint(1, 4), 16))
+        elif kind < 0.85:
+            result.append(blocks.BadBlock(x, y, 16, 16))
+        else:
+            result.append(actors.Enemy(24, 32).set_xy(x, y))
+    return result
+
+class _Unslotted:
+    "an entity's state in a plain __dict__, the way entities were stored before they had __slots__"
+    
+FLAG_NAMES = ("is_grounded", "is_left_walled", "is_right_walled", "is_left_toe_grounded", "is_right_toe_grounded", 
+        "is_crushed", "is_alive")     # the properties packed into Box._flags
+_COPY_CLASSES = {}      # entity class -> the class slotted_copy makes
+
+def _copied_slots(entity):
+    "(name, value) for each of entity's slots, with the rects, surfaces and containers in them copied"
+    for cls in type(entity).__mro__:
+        for name in getattr(cls, "__slots__", ()):
+            if hasattr(entity, name):
+                value = getattr(entity, name)
+                if isinstance(value, (pygame.Rect, pygame.Surface)):
+                    value = value.copy()
+                elif isinstance(value, (set, dict)):
+                    value = type(value)(value)
+                yield (name, value)
+
+def slotted_copy(entity):
+    "a copy of entity stored the way it is, to compare unslotted_copy against"
+    cls = type(entity)
+    if cls not in _COPY_CLASSES:
+        # no slots of its own, and doesn't release the PhysicsStore slot it shares with entity
+        _COPY_CLASSES[cls] = type(cls.__name__, (cls,), {"__slots__": (), "__del__": lambda self: None})
+    result = object.__new__(_COPY_CLASSES[cls])
+    for (name, value) in _copied_slots(entity):
+        setattr(result, name, value)
+    return result
+
+def unslotted_copy(entity):
+    "a copy of entity with every slot as a plain attribute, and its packed flags as separate booleans"
+    result = _Unslotted()
+    for (name, value) in _copied_slots(entity):
+        if name != "_flags":
+            setattr(result, name, value)
+    for name in FLAG_NAMES:
+        if hasattr(entity, name):
+            setattr(result, name, getattr(entity, name))
+    return result
+
+def _allocated_per_entity(build, n):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (result, (after - before) / n)
+    
+def _reads_per_second(entities):
+    actor_list = [x for x in entities if hasattr(x, "is_grounded")]
+    start = time.perf_counter()
+    reads = 0
+    for _ in range(5):
+        for x in entities:
+            x.is_solid; x.is_pushable; x.has_physics; x.rect; x.collision_layer
+        for x in actor_list:
+            x.is_grounded; x.is_left_walled; x.is_right_walled; x.is_left_toe_grounded; x.is_right_toe_grounded
+        reads += 5*len(entities) + 5*len(actor_list)
+    return reads / (time.perf_counter() - start)
+
+def entity_memory(n=50000):
+    """bytes allocated per entity, and entity attribute reads per second. Copies of the entities stored 
+       as they are and stored in a __dict__ like they used to be (see unslotted_copy) are compared too."""
+    (entities, total_bytes) = _allocated_per_entity(lambda: make_entities(n), n)
+    (copies, slotted_bytes) = _allocated_per_entity(lambda: [slotted_copy(x) for x in entities], n)
+    del copies
+    (copies, unslotted_bytes) = _allocated_per_entity(lambda: [unslotted_copy(x) for x in entities], n)
+    print("entity_memory: %d entities, %.0f bytes allocated per entity" % (n, total_bytes))
+    print("entity_memory: copying them takes %.0f bytes per entity with __slots__ and %.0f with a __dict__" % (
+        slotted_bytes, unslotted_bytes))
+    print("entity_memory: %.2f million attribute reads per second with __slots__ and %.2f with a __dict__" % (
+        _reads_per_second(entities) / 1e6, _reads_per_second(copies) / 1e6))
+
+def particle_burst(n=5000, frames=100):
+    "milliseconds per frame to step a burst of n particles falling onto a floor"
+    rng = random.Random(1234)
+    floor = blocks.Block(-1000, 200, 2000, 32)
+    occupancy = spatial.OccupancyMap([floor], group_key=lambda obj: (obj.collision_layer, obj.collision_mask))
+    emitter = particles.ParticleEmitter()
+    for _ in range(n):
+        emitter.emit(0, 0, ((0.5 - rng.random())*10, (0.5 - rng.random())*10), (255, 0, 0), frames + 1)
+    start = time.perf_counter()
+    for _ in range(frames):
+        emitter.update(1, occupancy)
+    elapsed = time.perf_counter() - start
+    print("particle_burst: %d particles, %.2f ms per frame" % (n, elapsed / frames * 1000))
+
+def path_expressions_in(json_data):
+    "every x_path and y_path expression in some level json"
+    if isinstance(json_data, dict):
+        for (key, value) in json_data.items():
+            if key in ("x_path", "y_path"):
+                yield value
+            else:
+                yield from path_expressions_in(value)
+    elif isinstance(json_data, list):
+        for value in json_data:
+            yield from path_expressions_in(value)
+
+def path_expressions(times=2000):
+    "evaluations per second of the sample level pack's path expressions, interpreted and compiled"
+    expressions = []
+    for filename in sorted(glob.glob(os.path.join("levels", "sample_level_pack", "*.json"))):
+        with open(filename) as f:
+            expressions.extend(path_expressions_in(json.load(f)))
+    expressions = sorted(set(expressions))
+    interpreted = [math_parser.pythonify(x) for x in expressions]
+    compiled = [math_parser.compile_function(x) for x in expressions]
+
+    start = time.perf_counter()
+    for f in interpreted:
+        for t in range(times):
+            f(t=t)
+    interpreted_rate = len(expressions)*times / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for f in compiled:
+        for t in range(times):
+            f(t)
+    compiled_rate = len(expressions)*times / (time.perf_counter() - start)
+    print("path_expressions: %d expressions, %.0f interpreted and %.0f compiled evaluations per second (%.1fx)" % (
+        len(expressions), interpreted_rate, compiled_rate, compiled_rate / interpreted_rate))
+
+def static_layer(frames=200):
+    "milliseconds per frame to draw a screen full of small static blocks, one by one and from a StaticLayer"
+    pygame.display.init()
+    screen = pygame.display.set_mode((800, 600))
+    rng = random.Random(1234)
+    tiles = []
+    for x in range(0, 4000, 16):
+        for y in range(0, 1200, 16):
+            if rng.random() < 0.4:
+                tiles.append(blocks.Block(x, y, 16, 16, color=(rng.randint(0, 255), 100, 100)))
+    index = spatial.AABBTree(tiles)
+    layer = drawing.StaticLayer(index, lambda obj: obj.rect.topleft)
+    for x in tiles:
+        layer.add(x)
+    cameras = [(i*7 % 3200, i*3 % 600) for i in range(frames)]
+
+    start = time.perf_counter()
+    for (cam_x, cam_y) in cameras:
+        view = pygame.Rect(cam_x, cam_y, 800, 600)
+        screen.blits([(x.image, (x.rect.x - cam_x, x.rect.y - cam_y)) for x in index.query(view)], False)
+    blocks_ms = (time.perf_counter() - start) / frames * 1000
+    for camera in cameras:      # renders every chunk once
+        for priority in layer.priorities():
+            layer.draw(screen, camera, priority)
+    start = time.perf_counter()
+    for camera in cameras:
+        for priority in layer.priorities():
+            layer.draw(screen, camera, priority)
+    layer_ms = (time.perf_counter() - start) / frames * 1000
+    print("static_layer: %d blocks, %.2f ms per frame one by one and %.2f ms from chunks" % (len(tiles), blocks_ms, layer_ms))
+    pygame.display.quit()
+
+def disjoint_rects(n=300, frames=50):
+    "milliseconds per frame to split a screen of n overlapping blocks and a few moving enemies into disjoint 3D rects"
+    rng = random.Random(1234)
+    entities = [blocks.Block(16*rng.randint(0, 40), 16*rng.randint(0, 30), 16*rng.randint(1, 6), 16*rng.randint(1, 4)) for _ in range(n)]
+    enemies = [actors.Enemy(24, 32).set_xy(rng.randint(0, 600), rng.randint(0, 440)) for _ in range(5)]
+    entity_list = sorted(enemies + entities, key=lambda x: -x.width()*x.height())
+    entity_list.sort(key=lambda x: x.get_update_priority())
+    drawer = drawing.Drawer(None)
+
+    uncached = 0
+    cached = 0
+    for frame in range(frames):
+        for enemy in enemies:
+            enemy.set_xy(enemy.x() + 2, enemy.y())
+        all_rects = [drawing.RECT_POOL.get().set_from_entity(x) for x in entity_list]
+        start = time.perf_counter()
+        for i in range(len(all_rects)):
+            all_rects[i].subtract_all(all_rects[i+1:])
+        uncached += time.perf_counter() - start
+        start = time.perf_counter()
+        drawer._get_disjoint_rects(entity_list, all_rects)
+        if frame > 0:   # the first frame fills the cache
+            cached += time.perf_counter() - start
+        drawing.RECT_POOL.put_back_all()
+    print("disjoint_rects: %d rects, %.2f ms per frame subtracting every pair and %.2f ms cached" % (
+        len(entity_list), uncached / frames * 1000, cached / (frames - 1) * 1000))
+
+BENCHMARKS = {
+    "disjoint_rects": disjoint_rects,
+    "entity_memory": entity_memory,
+    "particle_burst": particle_burst,
+    "path_expressions": path_expressions,
+    "static_layer": static_layer
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] if len(sys.argv) > 1 else sorted(BENCHMARKS.keys())
+    for name in names:
+        BENCHMARKS[name]()
@@ -1,11 +1,128 @@
 import pygame 
 import math
+from array import array
 
 import paths
 import utilities
 
+try:
+    import numpy
+except ImportError:
+    numpy = None    # PhysicsStore.integrate falls back to stepping bodies one at a time
+
+# Collision layers. The collision fixer only tests a pair of boxes if each box's 
+# collision_mask includes the other's collision_layer.
+LAYER_PLAYER    = 1 << 0
+LAYER_ENEMY     = 1 << 1
+LAYER_PARTICLE  = 1 << 2
+LAYER_STATIC    = 1 << 3
+LAYER_HAZARD    = 1 << 4
+LAYER_TRIGGER   = 1 << 5
+LAYER_ALL       = LAYER_PLAYER | LAYER_ENEMY | LAYER_PARTICLE | LAYER_STATIC | LAYER_HAZARD | LAYER_TRIGGER
+LAYER_TERRAIN   = LAYER_STATIC | LAYER_HAZARD | LAYER_TRIGGER     # everything blocks are made of
+
+# Bits of Box._flags, which packs the per-frame contact state of actors (and whether boxes are alive) into 
+# one int. The flags the collision loops read all the time (is_solid, is_pushable...) are plain slots.
+FLAG_GROUNDED       = 1 << 0
+FLAG_LEFT_WALLED    = 1 << 1
+FLAG_RIGHT_WALLED   = 1 << 2
+FLAG_LEFT_TOE       = 1 << 3
+FLAG_RIGHT_TOE      = 1 << 4
+FLAG_CRUSHED        = 1 << 5
+FLAG_ALIVE          = 1 << 6
+FLAG_CONTACTS       = FLAG_GROUNDED | FLAG_LEFT_WALLED | FLAG_RIGHT_WALLED | FLAG_LEFT_TOE | FLAG_RIGHT_TOE   # reset by each actor update
+
+def flag_property(bit):
+    "a boolean property stored as the given bit of _flags"
+    def get(self):
+        return (self._flags & bit) != 0
+    def set(self, value):
+        if value:
+            self._flags |= bit
+        else:
+            self._flags &= ~bit
+    return property(get, set)
+    
+def alive_property():
+    """the is_alive property of boxes that can die, stored as FLAG_ALIVE. When it becomes False, 
+       the list the box is in (see levels.EntityList) is told, so nothing has to scan for the dead."""
+    def get(self):
+        return (self._flags & FLAG_ALIVE) != 0
+    def set(self, value):
+        if value:
+            self._flags |= FLAG_ALIVE
+        elif self._flags & FLAG_ALIVE:
+            self._flags &= ~FLAG_ALIVE
+            if self._container != None:
+                self._container.mark_dead(self)
+    return property(get, set)
+
+class PhysicsStore:
+    """Struct of arrays holding the velocity, acceleration and speed limits of every Box, one slot 
+       per box, released when the box is garbage collected. Box's v, a, max_vx and max_vy are views 
+       into it, so integrate can step every body in one batched pass. Positions stay in each box's 
+       rect, which the collision fixers move in place."""
+    FIELDS = ("vx", "vy", "ax", "ay", "max_vx", "max_vy")
+    
+    def __init__(self):
+        for field in PhysicsStore.FIELDS:
+            setattr(self, field, array("d"))
+        self._free = []
+        
+    def allocate(self):
+        "returns the index of a zeroed slot"
+        if len(self._free) > 0:
+            slot = self._free.pop()
+            for field in PhysicsStore.FIELDS:
+                getattr(self, field)[slot] = 0
+            return slot
+        for field in PhysicsStore.FIELDS:
+            getattr(self, field).append(0)
+        return len(self.vx) - 1
+        
+    def release(self, slot):
+        self._free.append(slot)
+        
+    def integrate(self, bodies, dt):
+        "Box.apply_physics for each of bodies, computed in one vectorized pass if numpy is installed."
+        if numpy is None or len(bodies) == 0:
+            for body in bodies:
+                body.apply_physics(dt)
+            return
+        slots = numpy.fromiter([body._slot for body in bodies], dtype=numpy.intp, count=len(bodies))
+        vx, vy, ax, ay, max_vx, max_vy = [numpy.frombuffer(getattr(self, field)) for field in PhysicsStore.FIELDS]
+        
+        new_vx = vx[slots] + ax[slots]*dt
+        new_vy = vy[slots] + ay[slots]*dt
+        limit = max_vx[slots]
+        vx[slots] = numpy.where(new_vx > limit, limit, numpy.where(new_vx < -limit, -limit, new_vx))
+        limit = max_vy[slots]
+        new_vy = numpy.where(new_vy > limit, limit, numpy.where(new_vy < -limit, -limit, new_vy))
+        vy[slots] = new_vy
+        
+        # same as apply_physics: the unclamped vx moves the body, unless it's under 1
+        dx = numpy.where(numpy.abs(new_vx) < 1, 0.0, new_vx)*dt
+        dy = new_vy*dt
+        dx = numpy.where((dx != 0) & (numpy.abs(dx) < 1), numpy.copysign(1.0, dx), dx)
+        dy = numpy.where((dy != 0) & (numpy.abs(dy) < 1), numpy.copysign(1.0, dy), dy)
+        del vx, vy, ax, ay, max_vx, max_vy     # the arrays can't grow while numpy views of them exist
+        
+        for (body, body_dx, body_dy) in zip(bodies, dx.tolist(), dy.tolist()):
+            body.moved_from = (body.rect.x, body.rect.y)
+            body.move(body_dx, body_dy)
+
+PHYSICS = PhysicsStore()
+
+
 class Box(pygame.sprite.Sprite):
+    # pygame's Sprite has a __dict__, but it stays empty as long as everything's in a slot. 
+    # (_Sprite__g is the set of groups Sprite.__init__ adds)
+    __slots__ = ("_Sprite__g", "image", "color", "_flags", "is_solid", "is_pushable", "is_visible", "has_physics", 
+            "is_sleeping", "collision_layer", "collision_mask", "rect", "_slot", "moved_from", "rest_frames", 
+            "last_rest_state", "rf_parent", "rf_children", "theme_id", "_container", "_bucket", "_bucket_index")
+    
     def __init__(self, width, height, color=(128, 128, 128)):
+        self._flags = 0
         pygame.sprite.Sprite.__init__(self)
         self.image = pygame.Surface((width, height))
         self.color = color
@@ -16,27 +133,74 @@ class Box(pygame.sprite.Sprite):
         self.is_visible = True      # Whether this box renders.
         self.has_physics = True
         
+        self.collision_layer = LAYER_STATIC     # which layer this box belongs to
+        self.collision_mask = LAYER_ALL         # which layers this box can collide with
+        
         self.rect = pygame.Rect(0, 0, width, height)
+        self._slot = PHYSICS.allocate()     # where v, a, max_vx and max_vy live
         self.v = (0, 0)
         self.a = (0, 0.3)
+        self.moved_from = None      # where apply_physics last moved this box from, see CollisionFixer.solve_continuous
         
         self.max_vy = 15
         self.max_vx = 5
         
+        self.is_sleeping = False        # sleeping boxes are skipped by update and the collision fixer, see collisions.SleepFixer
+        self.rest_frames = 0            # how many frames this box has been at rest for
+        self.last_rest_state = None
+        
         self.rf_parent = None           # physics reference frame information. For example, when an actor stands on a moving platform
         self.rf_children = set()   # or is stuck to another object, it will enter that object's reference frame.
         self.theme_id = "default"
         
+        self._container = None      # the levels.EntityList this box is in, and where it is in there
+        self._bucket = None
+        self._bucket_index = 0
+        
+    def __del__(self):
+        if PHYSICS != None:     # (None if the module's being torn down)
+            PHYSICS.release(self._slot)
+        
     def update(self, dt):
-        if self.has_physics:
+        self.update_before_physics(dt)
+        if self.uses_physics():
             self.apply_physics(dt)
+        self.update_after_physics(dt)
+        
+    def update_before_physics(self, dt):
+        "Game logic that runs before this box's physics step. Everything's before steps run before any physics."
+        pass
+        
+    def update_after_physics(self, dt):
+        pass
+        
+    def uses_physics(self):
+        "whether apply_physics should run this frame"
+        return self.has_physics
+        
+    def update_kind(self):
+        """which of its level's active lists this box is in (see levels.EntityList.active), 
+           or None if updating it does nothing. Call behavior_changed when this changes."""
+        return "box" if self.has_physics else None
+        
+    def behavior_changed(self):
+        if self._container != None:
+            self._container.behavior_changed(self)
     
     def alive(self):
         return not hasattr(self, "is_alive") or self.is_alive
         
+    def can_sleep(self):
+        return self.is_pushable and self.has_physics
+        
+    def rest_state(self):
+        "the state that has to stay the same for this box to be considered at rest"
+        return (self.rect.x, self.rect.y, self.rect.width, self.rect.height, self.rf_parent)
+        
     def apply_physics(self, dt):
-        vx = self.vx() + self.a[0]*dt
-        vy = self.vy() + self.a[1]*dt
+        self.moved_from = (self.rect.x, self.rect.y)
+        vx = PHYSICS.vx[self._slot] + PHYSICS.ax[self._slot]*dt
+        vy = PHYSICS.vy[self._slot] + PHYSICS.ay[self._slot]*dt
         self.set_vx(vx)
         self.set_vy(vy)
         if abs(vx) < 1:
@@ -44,14 +208,14 @@ class Box(pygame.sprite.Sprite):
         self.move(vx*dt, self.vy()*dt, True)
         
     def move(self, dx, dy, move_at_least_1=False):
-        "Moves this object and all children in reference frame"
+        "Moves this object and everything in its reference frame, including their children"
         if move_at_least_1 and dx != 0 and abs(dx) < 1:
             dx = math.copysign(1, dx)
         if move_at_least_1 and dy != 0 and abs(dy) < 1:
             dy = math.copysign(1, dy) 
         self.rect.move_ip(dx, dy)
         for kid in self.rf_children:
-            kid.rect.move_ip(dx, dy)
+            kid.move(dx, dy)
             
     def set_x(self, x):
         dx = x - self.x()
@@ -64,8 +228,10 @@ class Box(pygame.sprite.Sprite):
         return self
         
     def set_xy(self, x, y):
+        "puts this box at (x, y), which isn't a move the continuous collisions should sweep"
         self.set_x(x)
         self.set_y(y)
+        self.moved_from = None
         return self
         
     def x(self):
@@ -93,29 +259,69 @@ class Box(pygame.sprite.Sprite):
         return (self.x(), self.y())
         
     def set_vx(self, vx):
-        if vx > self.max_vx:
-            vx = self.max_vx
-        elif vx < -self.max_vx:
-            vx = -self.max_vx
-        self.v = (vx, self.v[1])
+        limit = PHYSICS.max_vx[self._slot]
+        if vx > limit:
+            vx = limit
+        elif vx < -limit:
+            vx = -limit
+        PHYSICS.vx[self._slot] = vx
         
     def set_vy(self, vy):
-        if vy > self.max_vy:
-            vy = self.max_vy
-        elif vy < -self.max_vy:
-            vy = -self.max_vy
-        self.v = (self.v[0], vy)
+        limit = PHYSICS.max_vy[self._slot]
+        if vy > limit:
+            vy = limit
+        elif vy < -limit:
+            vy = -limit
+        PHYSICS.vy[self._slot] = vy
     
     def vx(self):
-        return self.v[0]
+        return PHYSICS.vx[self._slot]
         
     def vy(self):
-        return self.v[1]
+        return PHYSICS.vy[self._slot]
         
     def set_ax(self, ax):
-        self.a = (ax, self.a[1])
+        PHYSICS.ax[self._slot] = ax
+        
+    @property
+    def v(self):
+        return (PHYSICS.vx[self._slot], PHYSICS.vy[self._slot])
+        
+    @v.setter
+    def v(self, v):
+        PHYSICS.vx[self._slot] = v[0]
+        PHYSICS.vy[self._slot] = v[1]
+        
+    @property
+    def a(self):
+        return (PHYSICS.ax[self._slot], PHYSICS.ay[self._slot])
+        
+    @a.setter
+    def a(self, a):
+        PHYSICS.ax[self._slot] = a[0]
+        PHYSICS.ay[self._slot] = a[1]
+        
+    @property
+    def max_vx(self):
+        return PHYSICS.max_vx[self._slot]
+        
+    @max_vx.setter
+    def max_vx(self, max_vx):
+        PHYSICS.max_vx[self._slot] = max_vx
+        
+    @property
+    def max_vy(self):
+        return PHYSICS.max_vy[self._slot]
+        
+    @max_vy.setter
+    def max_vy(self, max_vy):
+        PHYSICS.max_vy[self._slot] = max_vy
         
     def add_to_rf(self, other):
+        parent = self
+        while parent != None:
+            assert parent is not other, "Error: Attempting circular rf"
+            parent = parent.rf_parent
         other.rf_parent = self
         self.rf_children.add(other)
         
@@ -134,6 +340,10 @@ class Box(pygame.sprite.Sprite):
         "direction = side of self that touched obj. Valid inputs are TOP, BOTTOM, LEFT, RIGHT, NONE"
         pass
     
+    def can_collide_with(self, other):
+        "whether the collision layers of self and other let them collide at all"
+        return (self.collision_mask & other.collision_layer) != 0 and (other.collision_mask & self.collision_layer) != 0
+    
     def get_color(self):
         return self.color
     
@@ -177,7 +387,6 @@ class Box(pygame.sprite.Sprite):
     def is_enemy(self): return False
     def is_ghost(self): return False
     def is_spawn_point(self): return False
-    def is_particle(self): return False
     
     def get_update_priority(self):
         if self.is_actor():
@@ -194,8 +403,10 @@ class Box(pygame.sprite.Sprite):
     
     
 class Block(Box):
+    __slots__ = ("_path", "_initial_xy")
     BAD_COLOR = (255, 0, 0)
     NORMAL_COLOR = (128, 128, 128)
+    PREDICTION_TICKS = 16   # how far ahead predicted_bounds looks
     
     def __init__(self, x, y, width, height, color=None): 
         color = Block.NORMAL_COLOR if color == None else color
@@ -212,6 +423,7 @@ class Block(Box):
     
     def set_path(self, path):
         self._path = path
+        self.behavior_changed()
         
     def get_path(self):
         return self._path
@@ -231,7 +443,7 @@ class Block(Box):
     def xy_initial(self):
         return self._initial_xy
     
-    def update(self, dt):
+    def update_after_physics(self, dt):
         if self._path != None:
             self.v = (0,0)
             old_x = self.x()
@@ -243,6 +455,44 @@ class Block(Box):
             self.set_y(self.y_initial() + xy[1])
             
             self.v = (self.x() - old_x, self.y() - old_y) # used for crushing 
+            
+    def update_kind(self):
+        return "moving_block" if self._path != None else Box.update_kind(self)
+        
+    def path_velocity(self):
+        """the exact velocity along its path right now, from the path's derivative, or None if it 
+           hasn't got one. v is still how far it actually moved last update, which is what crushing uses."""
+        if self._path != None:
+            return self._path.get_velocity()
+        return None
+        
+    def predicted_bounds(self, ticks=None):
+        """a rect around this block and where its path velocity says it'll be ticks updates from now, 
+           for broadphase grids to bin it by so they don't need updating every time it moves"""
+        ticks = Block.PREDICTION_TICKS if ticks == None else ticks
+        v = self.path_velocity()
+        if v == None:
+            v = self.v
+        return self.rect.union(self.rect.move(int(v[0]*ticks), int(v[1]*ticks)))
+        
+    def skip_ahead(self, dt):
+        """jumps this block dt along its path in one step, to where updating it over that time would have 
+           put it, and sets v to its velocity there. Whatever was riding it kept being updated on its own 
+           while it was frozen, so rather than being carried along they're dropped from its reference 
+           frame first. Returns the boxes it dropped."""
+        dropped = list(self.rf_children)
+        for kid in dropped:
+            self.remove_from_rf(kid)
+        if self._path != None:
+            self._path.step(dt)
+            xy = self._path.get_xy()
+            self.set_xy(self.x_initial() + xy[0], self.y_initial() + xy[1])
+            v = self._path.get_velocity()
+            if v == None:   # no derivative, so use how far the last tick of the path moves it
+                last = self._path.get_xy(self._path.t - 1)
+                v = (xy[0] - last[0], xy[1] - last[1])
+            self.v = v
+        return dropped
         
     def is_block(self): return True
     def is_moving_block(self): return self._path != None
@@ -272,9 +522,12 @@ class Block(Box):
         
 
 class BadBlock(Block):
+    __slots__ = ()
+    
     def __init__(self, x, y, width, height, color=None):
         color = Block.BAD_COLOR if color == None else color
         Block.__init__(self, x, y, width, height, color)
+        self.collision_layer = LAYER_HAZARD
     
     def collided_with(self, obj, dir="NONE"):
         if obj.is_actor():
@@ -297,8 +550,11 @@ class BadBlock(Block):
         
         
 class FinishBlock(Block):
+    __slots__ = ()
+    
     def __init__(self, x, y, width=16, height=16, color=(0, 255, 0)):
         Block.__init__(self, x, y, width, height, color)
+        self.collision_layer = LAYER_TRIGGER
         
     def collided_with(self, obj, dir="NONE"):
         if obj.is_actor():
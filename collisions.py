@@ -1,48 +1,297 @@
 import pygame
-from blocks import Block
+import random
+import unittest
+
+from blocks import Block, Box
+import spatial
+import utilities
+
+try:
+    import numpy
+except ImportError:
+    numpy = None    # the numpy backend is optional, without it everything runs on the python backend
 
 class ReferenceFrameFixer:
     def __init__(self):
-        pass
+        self._checked = {}  # kid -> (kid rect, parent rect) when it was last found to still be in its parent's rf
         
-    def solve_rfs(self, group):
-        to_delete = set()
-        for box in group:
-            to_delete.clear()
+    def solve_rfs(self, group, parents=None):
+        """Removes boxes that have left (or died in) their parent's reference frame. parents is the set 
+           of boxes with rf_children (usually a level's rf_parents, which the collision fixer adds to). 
+           Only kids that moved since they were last checked, or whose parent moved, are tested again. 
+           If parents isn't given, every box in group is checked."""
+        if parents is None:
+            parents = set([box for box in group if len(box.rf_children) > 0])
+            
+        checked = {}
+        to_delete = []
+        for box in list(parents):
+            if len(box.rf_children) == 0:
+                parents.discard(box)
+                continue
+            parent_rect = tuple(box.rect)
             for kid in box.rf_children:
-                if not kid.is_still_rf_child_of(box) or not kid.alive():
-                    to_delete.add(kid)
+                if not kid.alive():
+                    to_delete.append(kid)
+                    continue
+                state = (tuple(kid.rect), parent_rect)
+                if self._checked.get(kid) == state or kid.is_still_rf_child_of(box):
+                    checked[kid] = state
+                else:
+                    to_delete.append(kid)
             for kid in to_delete:
                 box.remove_from_rf(kid)
+            to_delete.clear()
+        self._checked = checked
                 
+
+class SleepFixer:
+    """Puts boxes that have been resting on something for sleep_frames frames to sleep, so they 
+       stop being updated and collided until something moves within margin pixels of them. Sleeping 
+       boxes within margin of each other form an island, and waking one box wakes its whole island."""
+    def __init__(self):
+        self.sleep_frames = 30
+        self.margin = 16    # more than anything moves in a frame, so boxes wake before they're touched
+        
+    def solve_sleeping(self, group, grid):
+        "grid is the spatial.SpatialHash that sleeping boxes are kept in (usually a level's sleep_grid)"
+        wakers = []
+        for sprite in group:
+            if sprite.is_sleeping or not sprite.alive():
+                continue
+            elif sprite.can_sleep():
+                state = sprite.rest_state()
+                if state != sprite.last_rest_state:
+                    sprite.last_rest_state = state
+                    sprite.rest_frames = 0
+                    if sprite.is_solid:
+                        wakers.append(sprite)
+                elif sprite.rf_parent != None and abs(sprite.vx()) < 1 and abs(sprite.vy()) < 1:   # resting on something
+                    sprite.rest_frames += 1
+                    if sprite.rest_frames >= self.sleep_frames:
+                        self.sleep(sprite, grid)
+                else:
+                    sprite.rest_frames = 0
+            elif sprite.is_solid and (sprite.is_actor() or sprite.v != (0, 0)):   # the player and moving blocks
+                wakers.append(sprite)
+        if len(grid) > 0:
+            self.wake_near(wakers, grid)
+            
+    def sleep(self, sprite, grid):
+        sprite.is_sleeping = True
+        grid.insert(sprite)
+        
+    def wake(self, sprite, grid):
+        sprite.is_sleeping = False
+        sprite.rest_frames = 0
+        grid.remove(sprite)
+        
+    def wake_near(self, sprites, grid):
+        "wakes the islands of sleeping boxes within margin of any of the given sprites"
+        margin = 2*self.margin
+        to_search = list(sprites)
+        while len(to_search) > 0:
+            rect = to_search.pop().rect.inflate(margin, margin)
+            for other in grid.query(rect):
+                if other.is_sleeping and other.rect.colliderect(rect):
+                    self.wake(other, grid)
+                    to_search.append(other)
+                    
+    def wake_all(self, group, grid):
+        for sprite in group:
+            if sprite.is_sleeping:
+                self.wake(sprite, grid)
+        grid.clear()
+        
+# Rect kernel used by the collision fixer. These functions take (x, y, w, h) tuples (or anything 
+# indexed the same way, pygame.Rects included), return plain tuples instead of new Rects, and 
+# reproduce the integer semantics of the pygame.Rect methods they replace exactly.
+
+def inflate(r, dx, dy):
+    "pygame.Rect.inflate: the deltas are truncated to ints and the rect is recentered with C style division"
+    dx = int(dx)
+    dy = int(dy)
+    return (r[0] - int(dx / 2), r[1] - int(dy / 2), r[2] + dx, r[3] + dy)
+    
+def h_box(r, thresh):
+    "r squashed vertically, used to detect horizontal collisions"
+    return inflate(r, 0, -r[3] * thresh)
+    
+def v_box(r, thresh):
+    "r squashed horizontally, used to detect vertical collisions"
+    return inflate(r, -r[2] * thresh, 0)
+
+def collide(a, b):
+    "pygame.Rect.colliderect"
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    if aw > 0 and ah > 0 and bw > 0 and bh > 0:
+        return ax < bx + bw and bx < ax + aw and ay < by + bh and by < ay + ah
+    if aw == 0 or ah == 0 or bw == 0 or bh == 0:
+        return False
+    return (min(ax, ax + aw) < max(bx, bx + bw) and 
+            min(ay, ay + ah) < max(by, by + bh) and 
+            max(ax, ax + aw) > min(bx, bx + bw) and 
+            max(ay, ay + ah) > min(by, by + bh))
+            
+def intersection(a, b):
+    "returns the overlap of a and b as an (x, y, w, h) tuple, or None if they don't collide"
+    if not collide(a, b):
+        return None
+    left  = max(a[0], b[0])
+    right = min(a[0] + a[2], b[0] + b[2])
+    top   = max(a[1], b[1])
+    bot   = min(a[1] + a[3], b[1] + b[3])
+    return (left, top, right - left, bot - top)
+    
+def center(pos, size):
+    "pygame.Rect.centerx (or centery) of a rect at pos with the given size"
+    return pos + int(size / 2)
+    
+def touches(boxes, r):
+    "whether either of the (h_box, v_box) pair boxes collides with r"
+    return collide(boxes[0], r) or collide(boxes[1], r)
+    
+def passes_through(r, dx, dy, b, axis):
+    """whether r moving by (dx, dy) gets its leading edge on axis out the far side of b while it still 
+       overlaps b on the other axis, ie. it tunnels through b rather than stopping inside it or sliding 
+       past one of its corners"""
+    d = dy if axis else dx
+    if d > 0:
+        t = (b[axis] + b[axis + 2] - r[axis] - r[axis + 2]) / d
+    elif d < 0:
+        t = (b[axis] - r[axis]) / d
+    else:
+        return False
+    if t >= 1:
+        return False
+    other = 1 - axis
+    lo = r[other] + (dx if axis else dy)*t
+    return lo < b[other] + b[other + 2] and lo + r[other + 2] > b[other]
+    
+def sweep(r, dx, dy, b):
+    """time of impact of r moving by (dx, dy) with b. Returns a (t, axis) pair where axis is 0 if r hit 
+       the left or right side of b and 1 if it hit the top or bottom, or None if r doesn't hit b during 
+       the move (or was overlapping it already). Starting out flush against b only counts as a hit if 
+       r goes on to pass through it."""
+    entry = [0, 0]
+    exit = [0, 0]
+    for axis in (0, 1):
+        d = dy if axis else dx
+        lo = r[axis]
+        hi = r[axis] + r[axis + 2]
+        b_lo = b[axis]
+        b_hi = b[axis] + b[axis + 2]
+        if d == 0:
+            if lo >= b_hi or hi <= b_lo:
+                return None
+            entry[axis] = float("-inf")
+            exit[axis] = float("inf")
+        elif d > 0:
+            entry[axis] = (b_lo - hi) / d
+            exit[axis] = (b_hi - lo) / d
+        else:
+            entry[axis] = (b_hi - lo) / d
+            exit[axis] = (b_lo - hi) / d
+    t = max(entry)
+    if t < 0 or t >= 1 or t >= min(exit):
+        return None
+    axis = 0 if entry[0] > entry[1] else 1
+    if t == 0 and not passes_through(r, dx, dy, b, axis):
+        return None
+    return (t, axis)
+    
+def intersect_direction(r1, r2, r1_boxes, r2_boxes):
+    """determines the direction from which r1 collides with r2, given the (h_box, v_box) pairs of both.
+       Returns one of TOP, BOTTOM, LEFT, RIGHT, NONE"""
+    if not touches(r1_boxes, r2):
+        return "NONE"
+    
+    h_box, v_box = r2_boxes
+    h_intersection = intersection(r1, h_box)
+    v_intersection = intersection(r1, v_box)
+    
+    if h_intersection != None and v_intersection != None:
+        # Colliding on both the guide rectangles, choose the one with larger overlap
+        if h_intersection[2] < v_intersection[3]:
+            v_intersection = None
+        else:
+            h_intersection = None
+    
+    if h_intersection == None:
+        if center(v_intersection[1], v_intersection[3]) - center(v_box[1], v_box[3]) > 0:
+            return "BOTTOM"
+        else:
+            return "TOP"
+    else:
+        if center(h_intersection[0], h_intersection[2]) - center(h_box[0], h_box[2]) > 0:
+            return "RIGHT"
+        else:
+            return "LEFT"
+
+
 class CollisionFixer:
     def __init__(self):
+        self.backend = "python"
         self.thresh = 0.4
+        self.contact_thresh = 0.2   # thresh used to work out which side movables touched each other on
+        self.sweep = spatial.SweepAndPrune()   # broadphase for movable-movable contacts, kept between frames
+        self.continuous = True      # whether fast movers are swept against static geometry, see solve_continuous
+        self.max_substeps = 4
         
-    def solve_collisions(self, group):
-        unmovables = []
-        movables = []
+    def solve_collisions(self, group, grid=None, static_index=None, rf_parents=None, occupancy=None):
+        """Resolves collisions between the solid sprites in group. grid is a spatial.SpatialHash 
+           of the solid unmovables that can move and static_index is a spatial.AABBTree of the ones 
+           that can't (usually a level's collision_grid and static_index). If no grid is given, 
+           a throwaway one containing every solid unmovable is built. Unmovables that movables 
+           land on are added to rf_parents (see ReferenceFrameFixer.solve_rfs). If occupancy (a 
+           spatial.OccupancyMap of the solid ones in static_index, grouped by (collision_layer, 
+           collision_mask)) is given, the ground and wall probes use it instead of static_index."""
+        if grid is None:
+            grid = spatial.SpatialHash()
+            static_index = None
+            for sprite in group:
+                if sprite.is_solid and not sprite.is_pushable:
+                    grid.insert(sprite)
+        
+        unmovables = {}     # sprite -> position in group, used to keep broadphase results in group order
+        movables = {}
         actors = []
         
         for sprite in group:
-            if sprite.is_solid == False or not sprite.alive():
+            if sprite.is_solid == False or not sprite.alive() or sprite.is_sleeping:
+                sprite.moved_from = None    # its move this frame won't be swept, so it mustn't be next frame either
                 continue
             elif sprite.is_pushable:
-                movables.append(sprite)
+                movables[sprite] = len(movables)
                 if sprite.is_actor():
                     actors.append(sprite)
             else:
-                unmovables.append(sprite)
+                unmovables[sprite] = len(unmovables)
+                if sprite.is_moving_block():
+                    grid.update(sprite, sprite.predicted_bounds)
         
+        if self.continuous and static_index != None:
+            self.solve_continuous(movables, static_index)
+        else:
+            self.clear_moved_from(movables)
+        
+        thresh = self.thresh
         for sprite in movables: # solving movable-unmovable coliisions
-            colliding_with = [x for x in unmovables if self.really_intersects(sprite.rect, x.rect, self.thresh)]
+            boxes = (h_box(sprite.rect, thresh), v_box(sprite.rect, thresh))
+            colliding_with = [x for x in self._nearby(sprite.rect, unmovables, grid, static_index) if sprite.can_collide_with(x) and touches(boxes, x.rect)]
             for other in colliding_with:
-                self.solve_pushout_collision(other, sprite)
+                self.solve_pushout_collision(other, sprite, rf_parents)
+        
+        # nothing moves for the rest of the frame, so each sprite's guide boxes only need computing once
+        boxes = {}
+        contact_boxes = {}
         
         for sprite in actors:   # Checking for crushed actors
-            colliding_with = [x for x in unmovables if self.really_intersects(sprite.rect, x.rect, self.thresh)]
+            sprite_boxes = self._boxes(sprite, thresh, boxes)
+            colliding_with = [x for x in self._nearby(sprite.rect, unmovables, grid, static_index) if sprite.can_collide_with(x) and touches(sprite_boxes, x.rect)]
             for obj in colliding_with:
-                direction = self.intersect_dir(obj.rect, sprite.rect, self.thresh)
+                direction = intersect_direction(obj.rect, sprite.rect, self._boxes(obj, thresh, boxes), sprite_boxes)
                 if direction != None and direction != "NONE":
                     crushed = (direction == "TOP" and obj.vy() > 0) or \
                         (direction == "BOTTOM" and obj.vy() < 0) or \
@@ -52,23 +301,27 @@ class CollisionFixer:
                         sprite.is_crushed = True
                         break
                     
+        occupancy_groups = {}   # (collision_layer, collision_mask) -> groups of occupancy it can collide with
         for sprite in actors: # Setting is_grounded, is_left_walled, is_right_walled for each actor
             full_rect = sprite.rect
-            bot_rect  = pygame.Rect(full_rect.x, full_rect.bottom, full_rect.width, 1).inflate(-full_rect.width*self.thresh, 0) # creating a skinny rect that lies directly underneath the sprite.
-            left_rect = pygame.Rect(full_rect.x-1, full_rect.y, 1, full_rect.height).inflate(0, -full_rect.height*self.thresh)
-            right_rect= pygame.Rect(full_rect.right, full_rect.y, 1, full_rect.height).inflate(0, -full_rect.height*self.thresh)
+            left, top, width, height = full_rect.x, full_rect.y, full_rect.width, full_rect.height
+            bot_rect  = inflate((left, top + height, width, 1), -width*thresh, 0) # creating a skinny rect that lies directly underneath the sprite.
+            left_rect = inflate((left - 1, top, 1, height), 0, -height*thresh)
+            right_rect= inflate((left + width, top, 1, height), 0, -height*thresh)
             
-            candidates = self.rect_collide(full_rect.inflate(2, 2), unmovables)
+            search_rect = full_rect.inflate(2, 2)
+            candidates = [x for x in self._nearby(search_rect, unmovables, grid, static_index if occupancy is None else None) if sprite.can_collide_with(x)]
+            candidates = self.rect_collide(search_rect, candidates)
             
             bot_collisions = self.rect_collide(bot_rect, candidates)
             if len(bot_collisions) > 0:
                 sprite.is_grounded = True
                 for othersprite in bot_collisions:  # setting toe collision states
-                    coll = self.rect_intersect(othersprite.rect, bot_rect)
+                    coll = intersection(othersprite.rect, bot_rect)
                     
-                    if coll.left == bot_rect.left:
+                    if coll[0] == bot_rect[0]:
                         sprite.is_left_toe_grounded = True
-                    if coll.right == bot_rect.right:
+                    if coll[0] + coll[2] == bot_rect[0] + bot_rect[2]:
                         sprite.is_right_toe_grounded = True
                     if sprite.is_left_toe_grounded and sprite.is_right_toe_grounded:
                         break
@@ -77,111 +330,571 @@ class CollisionFixer:
                 sprite.is_left_walled = True 
             if len(self.rect_collide(right_rect, candidates)) > 0:
                 sprite.is_right_walled = True
+                
+            if occupancy != None:   # static geometry, a probe touches a block iff it covers one of the probe's pixels
+                groups = self._occupancy_groups(sprite, occupancy, occupancy_groups)
+                bot_x, bot_y, bot_w, _ = bot_rect
+                if occupancy.row_span(bot_y, bot_x, bot_x + bot_w, groups):
+                    sprite.is_grounded = True
+                    if occupancy.occupied(bot_x, bot_y, groups):
+                        sprite.is_left_toe_grounded = True
+                    if occupancy.occupied(bot_x + bot_w - 1, bot_y, groups):
+                        sprite.is_right_toe_grounded = True
+                if occupancy.column_span(left_rect[0], left_rect[1], left_rect[1] + left_rect[3], groups):
+                    sprite.is_left_walled = True
+                if occupancy.column_span(right_rect[0], right_rect[1], right_rect[1] + right_rect[3], groups):
+                    sprite.is_right_walled = True
+        
+        self.sweep.sync(movables)
+        touching = {}
+        for (a, b) in self.sweep.find_pairs(lambda a, b: a.can_collide_with(b)):
+            touching.setdefault(a, []).append(b)
+            touching.setdefault(b, []).append(a)
         for sprite in movables: # solving movable-movable collisions
-            colliding_with = [x for x in movables if self.really_intersects(sprite.rect, x.rect, self.thresh) and sprite is not x]
+            if sprite not in touching:
+                continue
+            others = touching[sprite]
+            others.sort(key=movables.get)
+            sprite_boxes = self._boxes(sprite, thresh, boxes)
+            colliding_with = [x for x in others if touches(sprite_boxes, x.rect)]
             for other in colliding_with:
-                if other != sprite:
-                    dir = self.intersect_dir(other.rect, sprite.rect, 0.2)
-                    sprite.collided_with(other, dir)
+                dir = intersect_direction(other.rect, sprite.rect, 
+                        self._boxes(other, self.contact_thresh, contact_boxes), 
+                        self._boxes(sprite, self.contact_thresh, contact_boxes))
+                sprite.collided_with(other, dir)
+    
+    def solve_continuous(self, movables, static_index):
+        """Swept collisions against the static geometry in static_index. A box that moved further 
+           than the thinnest static block this frame could have passed through one, so it's swept 
+           from where apply_physics moved it from. If it tunnelled through something (its leading edge 
+           went out the far side while still level with it), it's put back 1 pixel 
+           inside the first thing it hit and the rest of its move along the other axis is swept 
+           again, up to max_substeps times. Slower boxes are left to the pushout."""
+        min_extent = static_index.min_extent()
+        for sprite in movables:
+            start = sprite.moved_from
+            sprite.moved_from = None
+            if start is None:
+                continue
+            dx = sprite.rect.x - start[0]
+            dy = sprite.rect.y - start[1]
+            if abs(dx) >= min_extent or abs(dy) >= min_extent:
+                self._sweep(sprite, start[0], start[1], dx, dy, static_index)
+                
+    def clear_moved_from(self, movables):
+        "what solve_continuous does to the boxes it doesn't sweep, so none are swept from a stale position later"
+        for sprite in movables:
+            sprite.moved_from = None
+                
+    def _sweep(self, sprite, x, y, dx, dy, static_index):
+        w = sprite.rect.width
+        h = sprite.rect.height
+        for _ in range(self.max_substeps):
+            if dx == 0 and dy == 0:
+                break
+            hit = None
+            swept = pygame.Rect(min(x, x + dx), min(y, y + dy), w + abs(dx), h + abs(dy))
+            for obj in static_index.query(swept):
+                if obj.is_solid and sprite.can_collide_with(obj):
+                    toi = sweep((x, y, w, h), dx, dy, obj.rect)
+                    if toi != None and (hit is None or toi[0] < hit[0]):
+                        hit = (toi[0], toi[1], obj.rect)
+            if hit is None:
+                break
+            t, axis, b = hit
+            if not passes_through((x, y, w, h), dx, dy, b, axis):
+                break   # it stopped inside b or slid past its corner, the pushout will deal with it
+            
+            if axis == 0:
+                new_x = b.x - w + 1 if dx > 0 else b.right - 1
+                new_y = y + int(t*dy)
+                dy = dy - int(t*dy)
+                dx = 0
+            else:
+                new_x = x + int(t*dx)
+                new_y = b.y - h + 1 if dy > 0 else b.bottom - 1
+                dx = dx - int(t*dx)
+                dy = 0
+            x = new_x
+            y = new_y
+        sprite.rect.topleft = (x + dx, y + dy)
         
-    def solve_pushout_collision(self, unmovable, movable):
+    def _nearby(self, rect, sprite_order, grid, static_index):
+        """Finds the sprites in sprite_order (a dict of sprite -> position) that may overlap rect
+           according to the grid and static_index. Returns them as a list sorted by position."""
+        result = [x for x in grid.query(rect) if x in sprite_order]
+        if static_index != None:
+            result.extend([x for x in static_index.query(rect) if x in sprite_order])
+        result.sort(key=sprite_order.get)
+        return result
+        
+    def _occupancy_groups(self, sprite, occupancy, cache):
+        "returns the (collision_layer, collision_mask) groups of occupancy that sprite can collide with"
+        key = (sprite.collision_layer, sprite.collision_mask)
+        if key not in cache:
+            cache[key] = [(layer, mask) for (layer, mask) in occupancy.groups() if (sprite.collision_mask & layer) != 0 and (mask & sprite.collision_layer) != 0]
+        return cache[key]
+        
+    def _boxes(self, sprite, thresh, cache):
+        "returns the sprite's (h_box, v_box) pair, computing it only if it isn't in cache yet"
+        if sprite in cache:
+            return cache[sprite]
+        result = (h_box(sprite.rect, thresh), v_box(sprite.rect, thresh))
+        cache[sprite] = result
+        return result
+        
+    def solve_pushout_collision(self, unmovable, movable, rf_parents=None):
+        "rf_parents is the set of boxes with rf_children, which unmovable is added to if movable lands on it"
         assert unmovable.is_pushable == False and movable.is_pushable == True
-        v_box = movable.rect.copy()
-        v_box.inflate_ip(-v_box.width * self.thresh, 0)
+        v = v_box(movable.rect, self.thresh)
         
-        intersect = self.rect_intersect(unmovable.rect, v_box)  # vertical correction
+        intersect = intersection(unmovable.rect, v)  # vertical correction
         if intersect != None:
-            if intersect.bottom == v_box.bottom:    # collision from bottom
-                movable.rect.move_ip(0, -intersect.height)
+            if intersect[1] + intersect[3] == v[1] + v[3]:    # collision from bottom
+                movable.rect.move_ip(0, -intersect[3])
                 if movable.vy() > 0:
                     movable.set_vy(0)
                 if movable.rf_parent != None:
                     movable.rf_parent.remove_from_rf(movable)
                 unmovable.add_to_rf(movable)
+                if rf_parents != None:
+                    rf_parents.add(unmovable)
                 movable.collided_with(unmovable, "BOTTOM")
                 unmovable.collided_with(movable, "TOP")
-            elif intersect.top == v_box.top:        # collision from top
-                movable.rect.move_ip(0, intersect.height)
+            elif intersect[1] == v[1]:        # collision from top
+                movable.rect.move_ip(0, intersect[3])
                 if movable.vy() < 0:
                     movable.set_vy(0)
                 movable.collided_with(unmovable, "TOP")
                 unmovable.collided_with(movable, "BOTTOM")
                 
-        h_box = movable.rect.copy()
-        h_box.inflate_ip(0, -h_box.height * self.thresh)
+        h = h_box(movable.rect, self.thresh)
 
-        intersect = self.rect_intersect(unmovable.rect, h_box)  # horizontal correction
+        intersect = intersection(unmovable.rect, h)  # horizontal correction
         if intersect != None:
-            if intersect.left == h_box.left:
-                movable.rect.move_ip(intersect.width, 0)
+            if intersect[0] == h[0]:
+                movable.rect.move_ip(intersect[2], 0)
                 movable.set_vx(0)
                 movable.set_ax(0)
                 movable.collided_with(unmovable, "LEFT")
                 unmovable.collided_with(movable, "RIGHT")
-            elif intersect.right == h_box.right:
-                movable.rect.move_ip(-intersect.width, 0)
+            elif intersect[0] + intersect[2] == h[0] + h[2]:
+                movable.rect.move_ip(-intersect[2], 0)
                 movable.set_vx(0)
                 movable.set_ax(0)
                 movable.collided_with(unmovable, "RIGHT")
                 unmovable.collided_with(movable, "LEFT")
         
     def rect_intersect(self, r1, r2):
-        if not r1.colliderect(r2):
-            return None
-        
-        left  = max(r1.x, r2.x)
-        right = min(r1.x + r1.width, r2.x + r2.width)
-        top   = max(r1.y, r2.y)
-        bot   = min(r1.y + r1.height, r2.y + r2.height)
-        
-        return pygame.Rect(left, top, right-left, bot-top)
+        "returns the overlap of r1 and r2 as an (x, y, w, h) tuple, or None"
+        return intersection(r1, r2)
         
     def intersect_dir(self, r1, r2, thresh):
         "determines the direction from which r1 collides with r2"
-        if not self.really_intersects(r1, r2, thresh):
-            return "NONE"
+        return intersect_direction(r1, r2, (h_box(r1, thresh), v_box(r1, thresh)), (h_box(r2, thresh), v_box(r2, thresh)))
         
-        h_box = self.h_box(r2, thresh)
-        v_box = self.v_box(r2, thresh)
+    def really_intersects(self, movable_rect, unmovable_rect, thresh):
+        return touches((h_box(movable_rect, thresh), v_box(movable_rect, thresh)), unmovable_rect)
+
+    def rect_collide(self, rect, sprite_list):
+        "Finds all the sprites in Group (or list) spritegroup that collide with given rect. Returns a list of those sprites."
+        return sorted([sprite for sprite in sprite_list if collide(rect, sprite.rect)], key=Block.__cmp__)
         
-        h_intersection = self.rect_intersect(r1, h_box)
-        v_intersection = self.rect_intersect(r1, v_box)
+    def h_box(self, rect, thresh):
+        return h_box(rect, thresh)
         
-        if h_intersection != None and v_intersection != None:
-            # Colliding on both the guide rectangles, choose the one with larger overlap
-            if h_intersection.width < v_intersection.height:
-                v_intersection = None
-            else:
-                h_intersection = None
+    def v_box(self, rect, thresh):
+        return v_box(rect, thresh)
+
+
+def create_collision_fixer(backend="python"):
+    "Returns a collision fixer for the given backend (python or numpy). Falls back to python if numpy isn't installed."
+    if backend == "numpy":
+        if numpy != None:
+            return NumpyCollisionFixer()
+        utilities.log("numpy isn't installed, using the python collision backend instead.")
+    elif backend != "python":
+        utilities.log("WARN: Unrecognized collision backend: "+str(backend))
+    return CollisionFixer()
+
+
+# Vectorized versions of the rect kernel. Rects are (x, y, w, h) tuples of int64 arrays, 
+# and the results broadcast the same way numpy arithmetic does.
+
+def _np_rects(boxes):
+    "converts a list of (x, y, w, h) tuples to a tuple of column arrays"
+    array = numpy.array(boxes, dtype=numpy.int64).reshape(-1, 4)
+    return (array[:, 0], array[:, 1], array[:, 2], array[:, 3])
+    
+def _np_inflate(r, dx, dy):
+    dx = numpy.trunc(dx).astype(numpy.int64)
+    dy = numpy.trunc(dy).astype(numpy.int64)
+    return (r[0] - numpy.trunc(dx / 2).astype(numpy.int64), r[1] - numpy.trunc(dy / 2).astype(numpy.int64), r[2] + dx, r[3] + dy)
+    
+def _np_h_box(r, thresh):
+    return _np_inflate(r, 0, -r[3] * thresh)
+    
+def _np_v_box(r, thresh):
+    return _np_inflate(r, -r[2] * thresh, 0)
+    
+def _np_column(r):
+    "reshapes r so it broadcasts down the rows of a matrix"
+    return tuple(x[:, None] for x in r)
+    
+def _np_row(r):
+    "reshapes r so it broadcasts across the columns of a matrix"
+    return tuple(x[None, :] for x in r)
+    
+def _np_take(r, indices):
+    return tuple(x[indices] for x in r)
+    
+def _np_collide(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    return ((aw != 0) & (ah != 0) & (bw != 0) & (bh != 0) & 
+            (numpy.minimum(ax, ax + aw) < numpy.maximum(bx, bx + bw)) & 
+            (numpy.minimum(ay, ay + ah) < numpy.maximum(by, by + bh)) & 
+            (numpy.maximum(ax, ax + aw) > numpy.minimum(bx, bx + bw)) & 
+            (numpy.maximum(ay, ay + ah) > numpy.minimum(by, by + bh)))
+            
+def _np_touches(boxes, r):
+    return _np_collide(boxes[0], r) | _np_collide(boxes[1], r)
+    
+def _np_center(pos, size):
+    return pos + numpy.trunc(size / 2).astype(numpy.int64)
+    
+DIRECTIONS = ("NONE", "TOP", "BOTTOM", "LEFT", "RIGHT")
+    
+def _np_intersect_direction(r1, r2, r1_boxes, r2_boxes):
+    "intersect_direction for arrays of rect pairs. Returns indices into DIRECTIONS"
+    h_box, v_box = r2_boxes
+    h_collide = _np_collide(r1, h_box)
+    v_collide = _np_collide(r1, v_box)
+    h_left  = numpy.maximum(r1[0], h_box[0])
+    h_width = numpy.minimum(r1[0] + r1[2], h_box[0] + h_box[2]) - h_left
+    v_top    = numpy.maximum(r1[1], v_box[1])
+    v_height = numpy.minimum(r1[1] + r1[3], v_box[1] + v_box[3]) - v_top
+    
+    # if both guide rectangles collide, choose the one with larger overlap
+    use_h = numpy.where(h_collide & v_collide, h_width < v_height, h_collide)
+    right = _np_center(h_left, h_width) - _np_center(h_box[0], h_box[2]) > 0
+    bottom = _np_center(v_top, v_height) - _np_center(v_box[1], v_box[3]) > 0
+    
+    result = numpy.where(use_h, numpy.where(right, 4, 3), numpy.where(bottom, 2, 1))
+    result[~(h_collide | v_collide)] = 0  # (the python backend can't classify these either)
+    result[~_np_touches(r1_boxes, r2)] = 0
+    return result
+    
+
+class NumpyCollisionFixer(CollisionFixer):
+    """Collision fixer backend for levels with thousands of solid boxes. All the rects are packed 
+       into numpy arrays and the overlap tests and direction classification are done on whole 
+       matrices at once, in batches of BATCH_SIZE rows. Pushouts still run one contact at a time 
+       because each one moves the box before the next contact is resolved, and collided_with 
+       callbacks only run for confirmed contacts, in the same order as the python backend."""
+    BATCH_SIZE = 256
+    
+    def __init__(self):
+        CollisionFixer.__init__(self)
+        self.backend = "numpy"
         
-        if h_intersection == None:
-            if v_intersection.centery - v_box.centery > 0:
-                return "BOTTOM"
+    def solve_collisions(self, group, grid=None, static_index=None, rf_parents=None, occupancy=None):
+        unmovables = []
+        movables = []
+        for sprite in group:
+            if sprite.is_solid == False or not sprite.alive() or sprite.is_sleeping:
+                sprite.moved_from = None    # its move this frame won't be swept, so it mustn't be next frame either
+                continue
+            elif sprite.is_pushable:
+                movables.append(sprite)
             else:
-                return "TOP"
+                unmovables.append(sprite)
+                if grid != None and sprite.is_moving_block():
+                    grid.update(sprite, sprite.predicted_bounds)     # keeps the grid usable if we switch back to the python backend
+        if len(movables) == 0:
+            return
+        if self.continuous and static_index != None:
+            self.solve_continuous(movables, static_index)
         else:
-            if h_intersection.centerx - h_box.centerx > 0:
-                return "RIGHT"
+            self.clear_moved_from(movables)
+        actors = [x for x in movables if x.is_actor()]
+        
+        thresh = self.thresh
+        u_rects = _np_rects([tuple(x.rect) for x in unmovables])
+        u_layers = self._layers(unmovables)
+        
+        # solving movable-unmovable collisions
+        m_rects = _np_rects([tuple(x.rect) for x in movables])
+        m_boxes = (_np_h_box(m_rects, thresh), _np_v_box(m_rects, thresh))
+        m_layers = self._layers(movables)
+        for (rows, hits) in self._batches(len(movables), lambda rows: 
+                self._layer_matrix(m_layers, u_layers, rows) & 
+                _np_touches(self._column_boxes(m_boxes, rows), _np_row(u_rects))):
+            for (i, row) in zip(rows, hits):
+                for j in numpy.flatnonzero(row):
+                    self.solve_pushout_collision(unmovables[j], movables[i], rf_parents)
+        
+        if len(actors) > 0:
+            a_rects = _np_rects([tuple(x.rect) for x in actors])
+            a_layers = self._layers(actors)
+            self._solve_crushes(actors, a_rects, a_layers, unmovables, u_rects, u_layers)
+            self._solve_contact_states(actors, a_rects, a_layers, u_rects, u_layers)
+        
+        # solving movable-movable collisions
+        m_rects = _np_rects([tuple(x.rect) for x in movables])
+        m_boxes = (_np_h_box(m_rects, thresh), _np_v_box(m_rects, thresh))
+        contact_boxes = (_np_h_box(m_rects, self.contact_thresh), _np_v_box(m_rects, self.contact_thresh))
+        for (rows, hits) in self._batches(len(movables), lambda rows: 
+                self._layer_matrix(m_layers, m_layers, rows) & 
+                (rows[:, None] != numpy.arange(len(movables))[None, :]) &
+                _np_touches(self._column_boxes(m_boxes, rows), _np_row(m_rects))):
+            pair_rows, others = numpy.nonzero(hits)
+            sprites = rows[pair_rows]
+            directions = _np_intersect_direction(
+                    _np_take(m_rects, others), _np_take(m_rects, sprites), 
+                    (_np_take(contact_boxes[0], others), _np_take(contact_boxes[1], others)),
+                    (_np_take(contact_boxes[0], sprites), _np_take(contact_boxes[1], sprites)))
+            for (i, j, dir) in zip(sprites, others, directions):
+                movables[i].collided_with(movables[j], DIRECTIONS[dir])
+                
+    def _solve_crushes(self, actors, a_rects, a_layers, unmovables, u_rects, u_layers):
+        thresh = self.thresh
+        a_boxes = (_np_h_box(a_rects, thresh), _np_v_box(a_rects, thresh))
+        u_boxes = (_np_h_box(u_rects, thresh), _np_v_box(u_rects, thresh))
+        u_vx = numpy.array([x.vx() for x in unmovables], dtype=float)
+        u_vy = numpy.array([x.vy() for x in unmovables], dtype=float)
+        for (rows, hits) in self._batches(len(actors), lambda rows: 
+                self._layer_matrix(a_layers, u_layers, rows) & 
+                _np_touches(self._column_boxes(a_boxes, rows), _np_row(u_rects))):
+            pair_rows, objs = numpy.nonzero(hits)
+            sprites = rows[pair_rows]
+            directions = _np_intersect_direction(
+                    _np_take(u_rects, objs), _np_take(a_rects, sprites),
+                    (_np_take(u_boxes[0], objs), _np_take(u_boxes[1], objs)),
+                    (_np_take(a_boxes[0], sprites), _np_take(a_boxes[1], sprites)))
+            crushed = (((directions == 1) & (u_vy[objs] > 0)) | ((directions == 2) & (u_vy[objs] < 0)) | 
+                    ((directions == 3) & (u_vx[objs] > 0)) | ((directions == 4) & (u_vx[objs] < 0)))
+            for i in numpy.unique(sprites[crushed]):
+                actors[i].is_crushed = True
+                
+    def _solve_contact_states(self, actors, a_rects, a_layers, u_rects, u_layers):
+        "sets is_grounded, is_left_walled, is_right_walled and the toe states of each actor"
+        thresh = self.thresh
+        x, y, w, h = a_rects
+        one = numpy.ones_like(w)
+        search_rects = (x - 1, y - 1, w + 2, h + 2)
+        bot_rects = _np_inflate((x, y + h, w, one), -w*thresh, 0)
+        left_rects = _np_inflate((x - 1, y, one, h), 0, -h*thresh)
+        right_rects = _np_inflate((x + w, y, one, h), 0, -h*thresh)
+        u_row = _np_row(u_rects)
+        
+        for rows in self._row_batches(len(actors)):
+            candidates = self._layer_matrix(a_layers, u_layers, rows) & _np_collide(_np_column(_np_take(search_rects, rows)), u_row)
+            bot = _np_column(_np_take(bot_rects, rows))
+            bot_hits = candidates & _np_collide(bot, u_row)
+            left_toes = bot_hits & (u_row[0] <= bot[0])
+            right_toes = bot_hits & (u_row[0] + u_row[2] >= bot[0] + bot[2])
+            left_hits = candidates & _np_collide(_np_column(_np_take(left_rects, rows)), u_row)
+            right_hits = candidates & _np_collide(_np_column(_np_take(right_rects, rows)), u_row)
+            
+            for (k, i) in enumerate(rows):
+                sprite = actors[i]
+                if bot_hits[k].any():
+                    sprite.is_grounded = True
+                    if left_toes[k].any():
+                        sprite.is_left_toe_grounded = True
+                    if right_toes[k].any():
+                        sprite.is_right_toe_grounded = True
+                if left_hits[k].any():
+                    sprite.is_left_walled = True
+                if right_hits[k].any():
+                    sprite.is_right_walled = True
+    
+    def _layers(self, sprites):
+        "returns the (collision_layer, collision_mask) arrays of the given sprites"
+        return (numpy.array([x.collision_layer for x in sprites], dtype=numpy.int64), 
+                numpy.array([x.collision_mask for x in sprites], dtype=numpy.int64))
+        
+    def _layer_matrix(self, a_layers, b_layers, rows):
+        "matrix of which of the given rows of a can collide with each b, see Box.can_collide_with"
+        a_layer = a_layers[0][rows][:, None]
+        a_mask = a_layers[1][rows][:, None]
+        return ((a_mask & b_layers[0][None, :]) != 0) & ((b_layers[1][None, :] & a_layer) != 0)
+        
+    def _column_boxes(self, boxes, rows):
+        return (_np_column(_np_take(boxes[0], rows)), _np_column(_np_take(boxes[1], rows)))
+    
+    def _row_batches(self, n):
+        for start in range(0, n, NumpyCollisionFixer.BATCH_SIZE):
+            yield numpy.arange(start, min(n, start + NumpyCollisionFixer.BATCH_SIZE))
+    
+    def _batches(self, n, matrix_function):
+        "yields (rows, matrix_function(rows)) for each batch of rows"
+        for rows in self._row_batches(n):
+            yield (rows, matrix_function(rows))
+
+
+class RectKernelTest(unittest.TestCase):
+    "the rect kernel has to agree with pygame.Rect exactly, otherwise collisions would resolve differently"
+    
+    def test(self):
+        rng = random.Random(12345)
+        for _ in range(20000):
+            a = self.random_rect(rng)
+            b = self.random_rect(rng)
+            thresh = rng.choice([0.2, 0.4, rng.random()])
+            
+            self.assertEqual(collide(a, b), pygame.Rect(a).colliderect(pygame.Rect(b)))
+            self.assertEqual(inflate(a, -a[2]*thresh, 3), tuple(pygame.Rect(a).inflate(-a[2]*thresh, 3)))
+            self.assertEqual(h_box(a, thresh), tuple(pygame.Rect(a).inflate(0, -a[3]*thresh)))
+            self.assertEqual(v_box(a, thresh), tuple(pygame.Rect(a).inflate(-a[2]*thresh, 0)))
+            self.assertEqual(center(a[0], a[2]), pygame.Rect(a).centerx)
+            if collide(a, b):
+                self.assertEqual(intersection(a, b), tuple(pygame.Rect(a).clip(pygame.Rect(b))))
             else:
-                return "LEFT"
+                self.assertEqual(intersection(a, b), None)
+    
+    def random_rect(self, rng):
+        return (rng.randint(-50, 50), rng.randint(-50, 50), rng.randint(0, 40), rng.randint(0, 40))
         
-    def really_intersects(self, movable_rect, unmovable_rect, thresh):
-        h_box = self.h_box(movable_rect, thresh)
-        v_box = self.v_box(movable_rect, thresh)
+    @unittest.skipIf(numpy == None, "numpy isn't installed")
+    def test_numpy(self):
+        "the numpy backend's kernel has to agree with the python one"
+        rng = random.Random(54321)
+        a = [self.random_rect(rng) for _ in range(5000)]
+        b = [self.random_rect(rng) for _ in range(5000)]
+        np_a = _np_rects(a)
+        np_b = _np_rects(b)
+        for thresh in (0.2, 0.4):
+            np_a_boxes = (_np_h_box(np_a, thresh), _np_v_box(np_a, thresh))
+            np_b_boxes = (_np_h_box(np_b, thresh), _np_v_box(np_b, thresh))
+            collisions = _np_collide(np_a, np_b)
+            directions = _np_intersect_direction(np_a, np_b, np_a_boxes, np_b_boxes)
+            for i in range(len(a)):
+                a_boxes = (h_box(a[i], thresh), v_box(a[i], thresh))
+                b_boxes = (h_box(b[i], thresh), v_box(b[i], thresh))
+                self.assertEqual(a_boxes, (tuple(x[i] for x in np_a_boxes[0]), tuple(x[i] for x in np_a_boxes[1])))
+                self.assertEqual(collisions[i], collide(a[i], b[i]))
+                if directions[i] != 0 or not touches(a_boxes, b[i]):
+                    self.assertEqual(DIRECTIONS[directions[i]], intersect_direction(a[i], b[i], a_boxes, b_boxes))
+
+class ContinuousCollisionTest(unittest.TestCase):
+    "fast boxes shouldn't pass through thin blocks"
+    
+    def test(self):
+        for dt in (1, 2, 4):
+            for continuous in (False, True):
+                floor = Block(0, 100, 200, 8)
+                box = Box(10, 10)
+                box.set_xy(50, 80)
+                box.v = (3, 14)
+                fixer = CollisionFixer()
+                fixer.continuous = continuous
+                for _ in range(10):
+                    box.update(dt)
+                    fixer.solve_collisions([floor, box], spatial.SpatialHash(), spatial.AABBTree([floor]))
+                if continuous:
+                    self.assertEqual(box.rect.bottom, floor.rect.top)
+                elif dt > 1:
+                    self.assertTrue(box.rect.top > floor.rect.bottom)   # tunnelled
+                    
+    def test_sweep(self):
+        self.assertEqual(sweep((0, 0, 10, 10), 0, 30, (0, 20, 50, 5)), (1/3, 1))
+        self.assertEqual(sweep((0, 0, 10, 10), 30, 0, (20, -5, 5, 50)), (1/3, 0))
+        self.assertEqual(sweep((0, 0, 10, 10), 30, 0, (20, 10, 5, 50)), None)   # passes just above
+        self.assertEqual(sweep((0, 0, 10, 10), 5, 5, (5, 5, 10, 10)), None)    # already overlapping
+        self.assertEqual(sweep((0, 0, 10, 10), 4, 9, (10, -20, 8, 23)), None)  # flush, slides past the corner
+        self.assertEqual(sweep((0, 0, 10, 10), 0, -20, (-5, -8, 50, 8)), (0, 1))    # flush, jumps through
         
-        return self.rect_intersect(h_box, unmovable_rect) != None or self.rect_intersect(v_box, unmovable_rect) != None
+    def test_flush_corner(self):
+        "a box flush against a thin wall that slides diagonally past its corner isn't pulled back onto it"
+        for continuous in (False, True):
+            wall = Block(416, -32, 8, 256)
+            box = Box(24, 32)
+            box.set_xy(392, 221)
+            fixer = CollisionFixer()
+            fixer.continuous = continuous
+            box.moved_from = (392, 221)
+            box.move(4, 9)
+            fixer.solve_collisions([wall, box], spatial.SpatialHash(), spatial.AABBTree([wall]))
+            self.assertEqual((box.x(), box.y()), (396, 230))
+            
+    def test_teleport(self):
+        "a box teleported after it moved, or one the fixer skipped, isn't swept from where it was"
+        import actors
+        for fixer in (CollisionFixer(), create_collision_fixer("numpy")):
+            floor = Block(0, 100, 200, 8)
+            box = Box(10, 10).set_xy(50, 80)
+            box.moved_from = (50, 70)   # apply_physics moved it this frame
+            box.set_xy(50, 150)         # and then it was put on the other side of the floor
+            fixer.solve_collisions([floor, box], spatial.SpatialHash(), spatial.AABBTree([floor]))
+            self.assertEqual((box.x(), box.y()), (50, 150))
+            
+            player = actors.Actor().set_xy(50, 30)
+            player.moved_from = (50, 10)
+            player.kill()               # killed after physics, so the fixer skips it
+            fixer.solve_collisions([floor, player], spatial.SpatialHash(), spatial.AABBTree([floor]))
+            self.assertEqual(player.moved_from, None)
+            player.reset()
+            player.move(0, 90)          # respawned below the floor
+            fixer.solve_collisions([floor, player], spatial.SpatialHash(), spatial.AABBTree([floor]))
+            self.assertEqual(player.y(), 120)   # not swept from (50, 10) and stopped on top of the floor
 
-    def rect_collide(self, rect, sprite_list):
-        "Finds all the sprites in Group (or list) spritegroup that collide with given rect. Returns a list of those sprites."
-        return sorted([sprite for sprite in sprite_list if rect.colliderect(sprite.rect)], key=Block.__cmp__)
+class ReferenceFrameTest(unittest.TestCase):
+    def test(self):
+        platform = Block(0, 100, 100, 10)
+        crate = Block(10, 80, 20, 20)
+        box = Box(10, 10).set_xy(15, 70)
+        platform.add_to_rf(crate)
+        crate.add_to_rf(box)
+        parents = set([platform, crate])
+        fixer = ReferenceFrameFixer()
         
-    def h_box(self, rect, thresh):
-        h_box = rect.copy()
-        h_box.inflate_ip(0, -h_box.height * thresh)
-        return h_box
+        platform.move(5, -3)    # nested frames move along with it
+        self.assertEqual((crate.x(), crate.y(), box.x(), box.y()), (15, 77, 20, 67))
+        fixer.solve_rfs([platform, crate, box], parents)
+        self.assertEqual(box.rf_parent, crate)
         
-    def v_box(self, rect, thresh):
-        v_box = rect.copy()
-        v_box.inflate_ip(-v_box.width * thresh, 0)
-        return v_box
+        box.move(0, -5)     # jumped off
+        fixer.solve_rfs([platform, crate, box], parents)
+        self.assertEqual(box.rf_parent, None)
+        fixer.solve_rfs([platform, crate, box], parents)
+        self.assertEqual(parents, set([platform]))
+        self.assertRaises(AssertionError, lambda: crate.add_to_rf(platform))
+        
+class FrozenBlockTest(unittest.TestCase):
+    def test(self):
+        import activation, paths, types
+        platform = Block(0, 100, 100, 10)
+        platform.set_path(paths.Path("2*t", "0"))
+        rider = Box(10, 10).set_xy(10, 90)
+        rider.has_physics = False   # so it doesn't fall while nothing's colliding it
+        platform.add_to_rf(rider)
+        level = types.SimpleNamespace(sleep_grid=spatial.SpatialHash())
+        scheduler = activation.ActivationScheduler(near_size=(200, 200), far_size=(400, 400))
+        player = Box(10, 10)
         
+        platform.v = (2, 0)         # how far it moved the last time it was updated
+        player.set_xy(2000, 0)      # far away, so the block is frozen
+        for i in range(30):
+            scheduler.schedule(level, [platform, rider], player, 1)
+        self.assertEqual((platform.x(), platform.y(), platform.v), (0, 100, (0, 0)))
+        scheduler.sleep_fixer.sleep(rider, level.sleep_grid)    # it came to rest on the frozen block
+        
+        player.set_xy(60, 0)        # back in range, so it's thawed
+        (updates, skipped) = scheduler.schedule(level, [platform, rider], player, 1)
+        self.assertEqual(updates, [(platform, 1), (rider, 1)])
+        self.assertEqual((platform.x(), platform.y()), (60, 100))
+        self.assertEqual(platform.v, platform.path_velocity())
+        self.assertEqual((rider.rf_parent, rider.x(), rider.y()), (None, 10, 90))   # dropped, not carried
+        self.assertEqual(platform.rf_children, set())
+        self.assertFalse(rider.is_sleeping)
+        self.assertEqual(len(level.sleep_grid), 0)
+        
+        platform.set_path(paths.Path("t*t", "0"))
+        platform.get_path().dx_fun = None      # without a derivative it uses how far the last tick moved it
+        platform.skip_ahead(10)
+        self.assertEqual(platform.v, (19, 0))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,218 @@
 import pygame 
+import math
+import collections
+import copy
 import blocks
 import utilities
-import random
 import timer
 import objectpool
+import paths
+
+class StaticLayer:
+    """A level's static blocks, pre-rendered into chunk_size by chunk_size surfaces as they're 
+       first needed, so drawing them is just blitting the few chunks the camera can see. Each 
+       update priority gets its own chunks, so the drawer can draw them between the dynamic 
+       entities in the same order as it draws entity_list. A chunk is only re-rendered after 
+       one of its blocks changes, which the level tells it about when the editor adds, removes, 
+       moves, resizes or recolors a static block. The chunks are colorkeyed and run length 
+       encoded, which pygame blits a lot faster than per-pixel alpha."""
+    CHUNK_SIZE = 512
+    MAX_CHUNKS = 48     # the least recently drawn chunks are thrown away past this many
+    COLOR_KEYS = [(255, 0, 255), (0, 255, 1), (1, 2, 3)]    # chunks are keyed with the first one none of their blocks use
+    
+    def __init__(self, static_index, sort_key, chunk_size=CHUNK_SIZE):
+        "sort_key orders the blocks the same way entity_list does, so overlapping ones are drawn the same way round"
+        self.static_index = static_index
+        self.sort_key = sort_key
+        self.chunk_size = chunk_size
+        self._chunks = collections.OrderedDict()    # (priority, chunk x, chunk y) -> its surface, or None if it's empty
+        self._drawn_in = {}     # block -> the keys of the chunks it was rendered into
+        self._priority_counts = {}  # update priority -> how many blocks have it
+        self.revision = 0   # goes up whenever a chunk is thrown away
+        
+    def add(self, obj):
+        priority = obj.get_update_priority()
+        self._priority_counts[priority] = self._priority_counts.get(priority, 0) + 1
+        self.invalidate(obj)
+        
+    def remove(self, obj):
+        priority = obj.get_update_priority()
+        self._priority_counts[priority] -= 1
+        if self._priority_counts[priority] == 0:
+            del self._priority_counts[priority]
+        self.invalidate(obj)
+        
+    def invalidate(self, obj):
+        "throws away the chunks obj was rendered into and the ones it overlaps now"
+        self.revision += 1
+        for key in self._drawn_in.pop(obj, ()):
+            self._chunks.pop(key, None)
+        for key in self._keys(obj.get_update_priority(), obj.rect):
+            self._chunks.pop(key, None)
+            
+    def clear(self):
+        self.revision += 1
+        self._chunks.clear()
+        self._drawn_in.clear()
+        
+    def priorities(self):
+        "the update priorities there are blocks with, in drawing order"
+        return sorted(self._priority_counts.keys())
+        
+    def draw(self, screen, camera_pos, priority):
+        "draws the blocks with the given update priority, only looking at the chunks under screen's clip area"
+        cam_x = int(math.floor(camera_pos[0]))
+        cam_y = int(math.floor(camera_pos[1]))
+        size = self.chunk_size
+        for key in self._keys(priority, screen.get_clip().move(cam_x, cam_y)):
+            chunk = self._chunk(key)
+            if chunk != None:
+                screen.blit(chunk, (key[1]*size - cam_x, key[2]*size - cam_y))
+                
+    def _keys(self, priority, rect):
+        "the keys of the chunks of that priority rect overlaps"
+        size = self.chunk_size
+        return [(priority, x, y) for x in range(rect.x // size, (rect.x + max(rect.width, 1) - 1) // size + 1)
+                for y in range(rect.y // size, (rect.y + max(rect.height, 1) - 1) // size + 1)]
+            
+    def _chunk(self, key):
+        if key in self._chunks:
+            self._chunks.move_to_end(key)
+        else:
+            self._chunks[key] = self._render(key)
+            while len(self._chunks) > self.MAX_CHUNKS:
+                self._chunks.popitem(last=False)
+        return self._chunks[key]
+        
+    def _render(self, key):
+        (priority, chunk_x, chunk_y) = key
+        size = self.chunk_size
+        area = pygame.Rect(chunk_x*size, chunk_y*size, size, size)
+        to_draw = [x for x in self.static_index.query(area) 
+                if x.get_update_priority() == priority and x.rect.colliderect(area) and x.alive()]
+        if len(to_draw) == 0:
+            return None
+        to_draw.sort(key=self.sort_key)
+        
+        colors = set(tuple(x.color) for x in to_draw)
+        color_key = next((x for x in StaticLayer.COLOR_KEYS if x not in colors), None)
+        chunk = pygame.Surface((size, size))
+        chunk.fill(color_key if color_key != None else (0, 0, 0))
+        chunk.blits([(x.image, (x.rect.x - area.x, x.rect.y - area.y)) for x in to_draw], False)
+        for x in to_draw:
+            self._drawn_in.setdefault(x, set()).add(key)
+        if color_key != None:
+            chunk.set_colorkey(color_key, pygame.RLEACCEL)
+        if pygame.display.get_surface() != None:
+            chunk = chunk.convert()
+        return chunk
+        
+
+class DirtyRects:
+    """Keeps track of which parts of the screen changed since the last frame, so that the drawer only 
+       repaints those and main.py only presents those, with pygame.display.update. Everything drawn over 
+       the level (dynamic entities, particles, GUI text) is repainted where it was last frame as well as 
+       where it is now. When the camera moves a few pixels the last frame is scrolled along with it and 
+       only the strips that scrolled into view are repainted, but every pixel has moved so the whole 
+       display is presented. Anything else (a bigger camera jump, another level or background color, an 
+       edited block, a frame drawn without planning one, like the menus) repaints and presents everything."""
+    MAX_SCROLL = 32         # camera moves further than this many pixels repaint everything
+    MAX_REGIONS = 16        # past this many the regions are merged into one
+    MAX_COVERAGE = 0.5      # repaints everything when the regions would cover more of the screen than this
+    MERGE_WASTE = 1.5       # two regions are merged if their union is at most this much bigger than both of them
+    
+    def __init__(self, max_scroll=MAX_SCROLL):
+        self.max_scroll = max_scroll
+        self._state = None      # whatever the whole picture depended on last frame
+        self._camera = None     # last frame's camera position, which has to be whole pixels for scrolling
+        self._previous = []     # screen rects of what was drawn over the level last frame
+        self._current = []      # and this frame
+        self._regions = None    # the rects being repainted this frame, or None if it's all of them
+        self._scrolled = False
+        self._planned = False
+        
+    def plan(self, screen, state, camera, drawn_over):
+        """Starts a frame, scrolling screen along with the camera if it can. state is anything the whole 
+           picture depends on, camera is the camera position (None if it's not whole pixels), and drawn_over 
+           are the screen rects of what's about to be drawn over the level. Returns the rects the level 
+           needs repainting in, or None if it needs repainting everywhere."""
+        self._planned = True
+        self._scrolled = False
+        previous = self._previous
+        self._previous = self._current = list(drawn_over)
+        last_camera = self._camera
+        self._camera = camera
+        if state != self._state or camera == None or last_camera == None:
+            self._state = state
+            self._regions = None
+            return None
+        
+        dx = camera[0] - last_camera[0]
+        dy = camera[1] - last_camera[1]
+        if abs(dx) > self.max_scroll or abs(dy) > self.max_scroll:
+            self._regions = None
+            return None
+        width, height = screen.get_size()
+        regions = [x.move(-dx, -dy) for x in previous] + self._current
+        if dx > 0:
+            regions.append(pygame.Rect(width - dx, 0, dx, height))
+        elif dx < 0:
+            regions.append(pygame.Rect(0, 0, -dx, height))
+        if dy > 0:
+            regions.append(pygame.Rect(0, height - dy, width, dy))
+        elif dy < 0:
+            regions.append(pygame.Rect(0, 0, width, -dy))
+        self._regions = self._merge(regions, screen.get_rect())
+        if self._regions != None and (dx != 0 or dy != 0):
+            screen.scroll(-dx, -dy)
+            self._scrolled = True
+        return self._regions
+        
+    def mark(self, rect):
+        "records that rect (in screen coordinates) was drawn over the level this frame"
+        self._current.append(pygame.Rect(rect))
+        
+    def present(self):
+        "shows the frame on the display"
+        if self._planned and self._regions != None and not self._scrolled:
+            pygame.display.update(self._regions + self._current)
+        else:
+            pygame.display.flip()
+        if not self._planned:
+            self.reset()
+        self._planned = False
+        
+    def reset(self):
+        "forgets the last frame, so the next one's repainted and presented in full"
+        self._state = None
+        self._camera = None
+        self._planned = False
+        
+    def _merge(self, rects, screen_rect):
+        """clips rects to the screen and merges the ones whose union isn't much bigger than they are, or returns 
+           None if they'd cover too much of it. Overlapping regions are fine, they're just repainted twice."""
+        rects = [x.clip(screen_rect) for x in rects]
+        rects = [x for x in rects if x.width > 0 and x.height > 0]
+        merged = True
+        while merged:
+            merged = False
+            result = []
+            for rect in rects:
+                for other in result:
+                    union = other.union(rect)
+                    if union.width*union.height <= DirtyRects.MERGE_WASTE*(other.width*other.height + rect.width*rect.height):
+                        other.union_ip(rect)
+                        merged = True
+                        break
+                else:
+                    result.append(rect)
+            rects = result
+        if len(rects) > DirtyRects.MAX_REGIONS:
+            rects = [rects[0].unionall(rects[1:])]
+        if sum(x.width*x.height for x in rects) > DirtyRects.MAX_COVERAGE*screen_rect.width*screen_rect.height:
+            return None
+        return rects
+        
 
 class Drawer:
     def __init__(self, settings):
@@ -11,11 +220,50 @@ class Drawer:
         self.camera_pos = (0,0)
         self.grid_spacing = 32
         self.grid_color = (50,50,50)
+        self.dirty_rects = DirtyRects()
+        self._disjoint_level = None
+        self._disjoint_cache = {}   # entity -> (what its disjoint rects depended on, its disjoint rects), for 3D mode
     
     def draw_level(self, screen, level, entity_list=None, draw_background=True):    
+        "with the dirty_rects setting on, only repaints the parts of the screen that changed since the last frame"
+        background_color = self.update_background_color(level.background_color)
+        regions = None
+        if (self.settings.dirty_rects() and entity_list == None and draw_background and not self.settings.draw_3d() 
+                and not self.settings.show_grid() and not self.settings.edit_mode()):
+            timer.start("planning dirty rects", "drawing")
+            regions = self._plan_dirty_rects(screen, level, background_color)
+            timer.end("planning dirty rects")
+        if regions == None:
+            self._draw_level(screen, level, entity_list, draw_background, background_color)
+        else:
+            for region in regions:
+                screen.set_clip(region)
+                self._draw_level(screen, level, entity_list, draw_background, background_color)
+            screen.set_clip(None)
+            
+    def _plan_dirty_rects(self, screen, level, background_color):
+        cam_x, cam_y = self.camera_pos
+        camera = (int(cam_x), int(cam_y)) if cam_x == int(cam_x) and cam_y == int(cam_y) else None
+        drawn_over = []
+        if camera != None:
+            view = pygame.Rect(camera, screen.get_size())
+            drawn_over = [x.rect.move(-camera[0], -camera[1]) for x in level.get_objects_in_rect(view, False) if x.alive()]
+            particle_rect = level.particles.bounds()
+            if particle_rect != None:
+                drawn_over.append(particle_rect.move(-camera[0], -camera[1]))
+        state = (level, screen, screen.get_size(), background_color, level.static_layer.revision)
+        return self.dirty_rects.plan(screen, state, camera, drawn_over)
+        
+    def present(self):
+        "shows what's been drawn this frame on the display"
+        if self.settings.dirty_rects():
+            self.dirty_rects.present()
+        else:
+            self.dirty_rects.reset()
+            pygame.display.flip()
+        
+    def _draw_level(self, screen, level, entity_list, draw_background, background_color):
         if draw_background:
-            background_color = level.background_color
-            background_color = self.update_background_color(background_color)
             screen.fill(background_color)
         
         if self.settings.show_grid():
@@ -28,35 +276,57 @@ class Drawer:
         
         if entity_list == None:
             entity_list = level.entity_list
+            self.draw_entities(screen, entity_list, level, level.particles)
+        else:
+            self.draw_entities(screen, entity_list, particles=level.particles)
         
-        self.draw_entities(screen, entity_list)  
+        if not self.settings.draw_3d():     # in 3D they're drawn along with the entities
+            timer.start("drawing particles", "drawing")
+            level.particles.draw(screen, self.camera_pos)
+            timer.end("drawing particles")
         
         if self.settings.edit_mode():
             self.draw_entities(screen, level.spawn_list) # draw spawn points
             
-            for entity in entity_list:  # draw moving block paths
-                if entity.is_moving_block():
-                    self.draw_path(screen, entity.get_path(), entity.xy_initial(), (255,255,0))      
+            moving_blocks = [entity for entity in entity_list if entity.is_moving_block()]
+            self.draw_paths(screen, moving_blocks, (255,255,0))
             
-    def draw_entities(self, screen, entity_list):
+    def draw_entities(self, screen, entity_list, level=None, particles=None):
+        """if the level entity_list belongs to is given, its spatial index is used to find what's onscreen. 
+           In 3D mode the particles of the given particles.ParticleEmitter are drawn in among the entities."""
+        use_static_layer = level != None and not self.settings.draw_3d()   # then the static blocks are drawn by level.static_layer
         timer.start("filtering offscreen entities", "drawing")
-        entity_list = self._filter_onscreen_and_alive_entities(screen, entity_list, 50)
+        entity_list = self._filter_onscreen_and_alive_entities(screen, entity_list, 50, level, not use_static_layer)
         timer.end("filtering offscreen entities")
         paths = []
         if self.settings.draw_3d():
+            if level != None and level is not self._disjoint_level:
+                self._disjoint_level = level
+                self._disjoint_cache = {}
             timer.start("filtering out player", "drawing")
             players, non_players = self._rem_players(entity_list)
-            random.shuffle(non_players)
             timer.end("filtering out player")
             
-            self._draw_entities_3D(screen, non_players)
+            particle_list = particles.in_rect(self._onscreen_rect(screen, 50)) if particles != None else []
+            self._draw_entities_3D(screen, non_players, particle_list)
             for entity in players:
                 self._decorate_sprite(entity)
                 self._draw_entity_2D(screen, entity)
         else:
+            static_priorities = level.static_layer.priorities() if use_static_layer else []
             for entity in entity_list:
+                # each static layer goes under the entities of its priority and above the ones before
+                while len(static_priorities) > 0 and static_priorities[0] <= entity.get_update_priority():
+                    self._draw_static_layer(screen, level, static_priorities.pop(0))
                 self._decorate_sprite(entity)
                 self._draw_entity_2D(screen, entity)
+            for priority in static_priorities:
+                self._draw_static_layer(screen, level, priority)
+                
+    def _draw_static_layer(self, screen, level, priority):
+        timer.start("drawing static layer", "drawing")
+        level.static_layer.draw(screen, self.camera_pos, priority)
+        timer.end("drawing static layer")
     
     def _rem_players(self, entity_list):
         "returns ([player_list], [nonplayer_list])"
@@ -77,7 +347,8 @@ class Drawer:
     def _draw_entity_2D(self, screen, entity):
         screen.blit(entity.image, (entity.rect.x - self.camera_pos[0], entity.rect.y - self.camera_pos[1]))
             
-    def _draw_entities_3D(self, screen, entity_list):
+    def _draw_entities_3D(self, screen, entity_list, particle_list=()):
+        "particle_list is (rect, color) for each particle to draw, see particles.ParticleEmitter.in_rect"
         timer.start("sorting entity list", "drawing")
         entity_list.sort(key=lambda x: -x.width()*x.height())
         entity_list.sort(key=lambda x: x.get_update_priority())
@@ -85,14 +356,12 @@ class Drawer:
         
         timer.start("creating rectangles", "drawing")
         all_rects = [RECT_POOL.get().set_from_entity(x) for x in entity_list]
+        # particles are last, where they'd sort as the smallest thing in the lowest priority
+        all_rects.extend(RECT_POOL.get().set(r.x, r.y, r.w, r.h, color, 0.02) for (r, color) in particle_list)
         timer.end("creating rectangles")
        
         timer.start("getting disjoint rects", "drawing")
-        disjoint_rects = []
-        for i in range(0, len(all_rects)):
-            r = all_rects[i]
-            sub = r.subtract_all(all_rects[i+1:])
-            disjoint_rects.extend(sub)
+        disjoint_rects = self._get_disjoint_rects(entity_list, all_rects)
         timer.end("getting disjoint rects")
         
         
@@ -164,6 +433,46 @@ class Drawer:
         timer.end("drawing rects")
         
     
+    def _get_disjoint_rects(self, entity_list, all_rects):
+        """each rect minus all the rects after it, which only depends on the ones after it that it overlaps. 
+           So every entity's pieces are cached along with those, and only recomputed once it or something 
+           overlapping it has moved, which static blocks on their own never do. The rects after the 
+           entities' are particles, which don't last long enough to be worth caching."""
+        later = self._get_later_overlaps(all_rects)
+        disjoint_rects = []
+        for (i, r) in enumerate(all_rects):
+            others = [all_rects[j] for j in later[i]]
+            if i >= len(entity_list):
+                disjoint_rects.extend(r.subtract_all(others))
+                continue
+            entity = entity_list[i]
+            key = (r.top_left, r.bottom_right, r.w, r.h, r.color, r.depth, [(x.top_left, x.bottom_right, x.w, x.h) for x in others])
+            cached = self._disjoint_cache.get(entity)
+            if cached == None or cached[0] != key:
+                # the pieces come from RECT_POOL, which reuses them next frame
+                cached = (key, [copy.copy(x) for x in r.subtract_all(others)])
+                self._disjoint_cache[entity] = cached
+            disjoint_rects.extend(cached[1])
+        return disjoint_rects
+        
+    def _get_later_overlaps(self, all_rects):
+        "later[i] = the indices after i of the rects that overlap all_rects[i], in order. Found by sweeping along x."
+        later = [[] for _ in all_rects]
+        active = []
+        for i in sorted(range(len(all_rects)), key=lambda i: all_rects[i].x):
+            r = all_rects[i]
+            active = [j for j in active if all_rects[j].x2 > r.x]
+            for j in active:
+                if r.intersects(all_rects[j]):
+                    if i < j:
+                        later[i].append(j)
+                    else:
+                        later[j].append(i)
+            active.append(i)
+        for indices in later:
+            indices.sort()
+        return later
+    
     def _draw_rects_3D(self, screen, rect_list):
         fronts_and_backs = [self._get_front_and_back_corners_2(screen, r) for r in rect_list]
         convex_hulls = [self._convex_hull(corners) for corners in fronts_and_backs]
@@ -271,14 +580,28 @@ class Drawer:
                 
         return res
         
-    def _filter_onscreen_and_alive_entities(self, screen, entity_list, icing=0):
-        return [x for x in entity_list if self._is_onscreen(screen, x, icing) and x.alive()]
+    def _filter_onscreen_and_alive_entities(self, screen, entity_list, icing=0, level=None, include_static=True):
+        "onscreen means under screen's clip area, which is all of it unless only part of it's being repainted"
+        view = screen.get_clip()
+        if level != None:
+            entity_list = level.get_objects_in_rect(self._onscreen_rect(screen, icing), include_static)
+        return [x for x in entity_list if self._is_onscreen(view, x, icing) and x.alive()]
+        
+    def _onscreen_rect(self, screen, icing=0):
+        """the area in game coordinates under screen's clip area, with icing pixels around it. The camera 
+           position can be fractional, so it's a pixel bigger on each side."""
+        view = screen.get_clip()
+        return pygame.Rect(
+                int(math.floor(self.camera_pos[0])) + view.x - icing - 1, 
+                int(math.floor(self.camera_pos[1])) + view.y - icing - 1, 
+                view.width + 2*icing + 2, 
+                view.height + 2*icing + 2)
     
-    def _is_onscreen(self, screen, entity, icing):
-        screen_x = self.camera_pos[0] - icing
-        screen_y = self.camera_pos[1] - icing
-        screen_w = screen.get_width() + 2*icing 
-        screen_h = screen.get_height() + 2*icing
+    def _is_onscreen(self, view, entity, icing):
+        screen_x = self.camera_pos[0] + view.x - icing
+        screen_y = self.camera_pos[1] + view.y - icing
+        screen_w = view.width + 2*icing 
+        screen_h = view.height + 2*icing
         
         return not (screen_x + screen_w <= entity.x() or 
                 screen_y + screen_h <= entity.y() or
@@ -286,14 +609,18 @@ class Drawer:
                 screen_y >= entity.y() + entity.height())
     
     def draw_path(self, screen, path, offset, color, start_t=0, end_t=360, step=30):
+        self._draw_polyline(screen, path, path.get_polyline(start_t, end_t, step), offset, color)
+            
+    def draw_paths(self, screen, moving_blocks, color, start_t=0, end_t=360, step=30):
+        "draws every block's path, evaluating them all in one batch"
+        block_paths = [block.get_path() for block in moving_blocks]
+        for (block, path, polyline) in zip(moving_blocks, block_paths, paths.polylines(block_paths, start_t, end_t, step)):
+            self._draw_polyline(screen, path, polyline, block.xy_initial(), color)
+            
+    def _draw_polyline(self, screen, path, polyline, offset, color):
         offset = self._sub(self.camera_pos, offset)
-        if path.is_funct_path():
-            times = range(start_t, end_t, step)
-            points = [self._sub(path.get_xy(t), offset) for t in times]
-            closed = False
-        elif path.is_point_path():
-            points = [self._sub(xy, offset) for xy in zip(path.x_points, path.y_points)]
-            closed = True
+        points = [self._sub(xy, offset) for xy in polyline]
+        closed = path.is_point_path()
             
         pygame.draw.lines(screen, color, closed, points, 2)
     
@@ -383,7 +710,7 @@ class _Rect:
         return self
     
     def set_from_entity(self, entity):
-        depth = 0.02 if entity.is_spawn_point() or entity.is_finish_block() or entity.is_ghost() or entity.is_particle() else .1
+        depth = 0.02 if entity.is_spawn_point() or entity.is_finish_block() or entity.is_ghost() else .1
         return self.set(entity.x(), entity.y(), entity.width(), entity.height(), entity.color, depth)
                 
     def corners(self):
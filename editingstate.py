@@ -10,6 +10,7 @@ import blocks, actors
 import drawing
 import levels
 import utilities
+import timer
 
 class EditingState(InGameState):
     SELECTED_COLOR = (255, 128, 255)
@@ -106,7 +107,10 @@ class EditingState(InGameState):
         if self.settings.frozen_mode():
             dt = 0
         
-        for item in self.get_entities():
+        entities = self.get_entities()
+        active = entities.active()
+        timer.count("skipped updates", len(entities) - len(active))
+        for item in active:
             if item is not self.get_player():
                 item.update(dt)
         
@@ -149,6 +153,7 @@ class EditingState(InGameState):
         if self.selected != None:
             self.selected.set_color(self.selected_old_color)
             self.selected_old_color = None
+            self.get_current_level().repaint_object(self.selected)
         
         self.selected = obj
         
@@ -156,6 +161,7 @@ class EditingState(InGameState):
             utilities.log(str(self.selected) + " selected!")
             self.selected_old_color = self.selected.color
             self.selected.set_color(EditingState.SELECTED_COLOR)
+            self.get_current_level().repaint_object(self.selected)
             
     def delete_selected(self):
         if self.selected != None:
@@ -169,6 +175,7 @@ class EditingState(InGameState):
             width = self.selected.width()
             height = self.selected.height()
             self.selected.set_size(max(8, width + width_expand), max(8, height + height_expand))
+            self.get_current_level().refresh_object(self.selected)
             
     def move_selected(self, x_move, y_move):
         if self.selected != None:
@@ -178,6 +185,7 @@ class EditingState(InGameState):
                 block = self.selected
                 block.set_x_initial(block.x_initial() + x_move)
                 block.set_y_initial(block.y_initial() + y_move)
+            self.get_current_level().refresh_object(self.selected)
             
     def duplicate_selected(self):
         if self.selected != None:
@@ -58,6 +58,7 @@ SHOW_GRID       = register("show_grid")
 INVINCIBLE_MODE = register("invincible_mode")
 FREEZE_MODE     = register("freeze_mode")
 TOGGLE_3D       = register("toggle_3d")
+TOGGLE_COLLISION_BACKEND = register("toggle_collision_backend")
 
 SHIFT           = register("shift")
 CTRL            = register("ctrl")
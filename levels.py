@@ -1,6 +1,7 @@
 import sys
 import json
 import os
+import bisect
 
 import pygame
 
@@ -10,21 +11,133 @@ import gamestate
 import options
 import utilities
 import level_loader
+import spatial
+import particles
+import drawing
 
+class EntityList:
+    """A level's entities, bucketed by get_update_priority. Iterating goes through the buckets in 
+       priority order and each bucket in insertion order, the same order a stable sort by priority 
+       gives. Appending is O(1). Removing is O(1) too: the entity's slot in its bucket is cleared 
+       through the index it keeps of it, and the holes are compacted out (in order) the next time 
+       the list is iterated. Boxes that die tell the list they're in (see blocks.alive_property), 
+       so take_dead doesn't have to scan for them."""
+    def __init__(self, entities=()):
+        self._buckets = {}      # priority -> list of entities, with None where one's been removed
+        self._priorities = []   # sorted keys of _buckets
+        self._count = 0
+        self._holes = 0
+        self._flat = []         # every entity in order, rebuilt when it's next needed after a change
+        self._active = {}       # update kind -> the entities of that kind in order, rebuilt along with _flat
+        self._active_flat = []  # the entities with any update kind, in order
+        self._flat_dirty = False
+        self._dead = {}         # entities that have died since the last take_dead, in order of death
+        for entity in entities:
+            self.append(entity)
+            
+    def append(self, obj):
+        priority = obj.get_update_priority()
+        if priority not in self._buckets:
+            self._buckets[priority] = []
+            bisect.insort(self._priorities, priority)
+        bucket = self._buckets[priority]
+        obj._container = self
+        obj._bucket = bucket
+        obj._bucket_index = len(bucket)
+        bucket.append(obj)
+        self._count += 1
+        self._flat_dirty = True
+        if obj.alive() == False:
+            self.mark_dead(obj)
+        
+    def remove(self, obj):
+        if obj not in self:
+            raise ValueError(str(obj) + " is not in the EntityList")
+        obj._bucket[obj._bucket_index] = None
+        obj._container = None
+        obj._bucket = None
+        self._dead.pop(obj, None)
+        self._count -= 1
+        self._holes += 1
+        self._flat_dirty = True
+        
+    def behavior_changed(self, obj):
+        "called by entities in this list when their update_kind (or update priority) changes"
+        if obj._bucket is not self._buckets.get(obj.get_update_priority()):
+            self.remove(obj)
+            self.append(obj)
+        self._flat_dirty = True
+        
+    def mark_dead(self, obj):
+        "called by entities in this list when they die"
+        self._dead[obj] = None
+        
+    def take_dead(self):
+        "returns the entities that have died since the last call, in order of death"
+        result = list(self._dead.keys())
+        self._dead.clear()
+        return result
+        
+    def as_list(self):
+        if self._flat_dirty:
+            self._rebuild()
+        return self._flat
+        
+    def active(self, kind=None):
+        """the entities whose update does anything, in order. If kind is given, only the ones 
+           whose update_kind is kind, eg. "moving_block", "actor", "enemy" or "ghost"."""
+        if self._flat_dirty:
+            self._rebuild()
+        if kind is None:
+            return self._active_flat
+        return self._active.get(kind, [])
+        
+    def _rebuild(self):
+        flat = []
+        for priority in self._priorities:
+            bucket = self._buckets[priority]
+            if self._holes > 0 and None in bucket:
+                bucket[:] = [obj for obj in bucket if obj is not None]
+                for (i, obj) in enumerate(bucket):
+                    obj._bucket_index = i
+            flat.extend(bucket)
+        active = {}
+        active_flat = []
+        for obj in flat:
+            kind = obj.update_kind()
+            if kind != None:
+                active.setdefault(kind, []).append(obj)
+                active_flat.append(obj)
+        self._holes = 0
+        self._flat = flat
+        self._active = active
+        self._active_flat = active_flat
+        self._flat_dirty = False
+        
+    def __iter__(self):
+        return iter(self.as_list())
+        
+    def __contains__(self, obj):
+        return getattr(obj, "_container", None) is self
+        
+    def __len__(self):
+        return self._count
+        
+        
 class Level:
     def __init__(self, name, entity_list, spawn_list, theme_dict, filename):
         self.name = name
         self.num = -1
-        self.entity_list = entity_list[:]
-        self._entity_list_dirty = True # List needs sorting
+        entity_list = entity_list[:]
         self.spawn_list = spawn_list[:]
         self.theme_lookup = dict(theme_dict)
         self.background_color = self.theme_lookup["default"].values["background_color"]
         self.filename = filename
         
         for spawner in spawn_list:
-            self.entity_list.append(spawner.get_actor())
+            entity_list.append(spawner.get_actor())
             spawner.do_spawn()
+        self.entity_list = EntityList(entity_list)
             
         for entity in self.entity_list:
             theme_id = entity.get_theme_id()
@@ -37,39 +150,101 @@ class Level:
         self.actor = self._find_player()
         if self.actor == None:
             utilities.log("levels.Level: Warning: No actor found in loaded level!")
-        self.sort_if_dirty()
+        
+        # Spatial lookups. Non-moving blocks go in static_index, which is built once here and shared by 
+        # the collision fixer, the drawer and editor picking. Solid unmovables that do move (ie. moving blocks) 
+        # go in collision_grid, where the collision fixer re-bins them whenever they cross a cell boundary.
+        self.static_index = spatial.AABBTree()
+        self.static_occupancy = spatial.OccupancyMap(group_key=lambda obj: (obj.collision_layer, obj.collision_mask))  # the solid ones, for ground/wall probes
+        self.collision_grid = spatial.SpatialHash()
+        self.sleep_grid = spatial.SpatialHash()   # the sleeping boxes, maintained by collisions.SleepFixer
+        self.rf_parents = set()     # boxes with rf_children, maintained by the collision fixers
+        self.particles = particles.ParticleEmitter()    # blood and such, which isn't made of entities
+        self.static_layer = drawing.StaticLayer(self.static_index, self._sort_key)   # the static blocks, pre-rendered in chunks
+        self._dynamic_entities = []     # everything not in static_index
+        for entity in self.entity_list:
+            self._index_object(entity)
+        self.static_index.rebuild()
+        
+        # moving blocks look their positions up in tables, when their paths repeat
+        paths.build_tables([entity.get_path() for entity in self.entity_list if entity.is_moving_block()])
     
-    def _sort_entities(self):
-        self.entity_list.sort(key=lambda x: x.get_update_priority())
-        self._entity_list_dirty = False
+    def _sort_key(self, obj):
+        "matches the order of entity_list"
+        return (obj.get_update_priority(), obj._bucket_index)
     
-    def add_object(self, obj, sort_now=True):
-        self.entity_list.append(obj)
-        if sort_now:
-            self._sort_entities()
+    def is_static(self, obj):
+        "whether obj is indexed in static_index and drawn by static_layer"
+        return obj.is_block() and not obj.is_moving_block()
+    
+    def _index_object(self, obj):
+        if self.is_static(obj):
+            self.static_index.insert(obj)
+            self.static_layer.add(obj)
+            if obj.is_solid and not obj.is_pushable:
+                self.static_occupancy.insert(obj)
         else:
-            self._entity_list_dirty = True
-        
-    def sort_if_dirty(self):
-        if self._entity_list_dirty:
-            self._sort_entities()
+            self._dynamic_entities.append(obj)
+            if obj.is_solid and not obj.is_pushable:
+                self.collision_grid.insert(obj)
+                
+    def _unindex_object(self, obj):
+        if self.is_static(obj):
+            self.static_index.remove(obj)
+            self.static_layer.remove(obj)
+            self.static_occupancy.remove(obj)
+        else:
+            self._dynamic_entities.remove(obj)
+            self.collision_grid.remove(obj)
+            self.sleep_grid.remove(obj)
+        self.rf_parents.discard(obj)
+    
+    def add_object(self, obj):
+        self.entity_list.append(obj)
+        self._index_object(obj)
         
     def remove_object(self, obj):
-        index = self.entity_list.index(obj)
-        del self.entity_list[index]
+        self.entity_list.remove(obj)
+        self._unindex_object(obj)
+        
+    def refresh_object(self, obj):
+        "Must be called after an object is moved or resized outside of the game loop (eg. by the editor)."
+        if self.is_static(obj):
+            self.static_index.mark_dirty()
+            self.static_occupancy.mark_dirty()
+            self.static_layer.invalidate(obj)
+        elif obj in self.collision_grid:
+            self.collision_grid.update(obj)
+            
+    def repaint_object(self, obj):
+        "Must be called after an object's color or image is changed outside of the game loop (eg. by the editor)."
+        if self.is_static(obj):
+            self.static_layer.invalidate(obj)
         
     def get_objects_at(self, xy):
         x, y = xy
-        return [obj for obj in self.entity_list if obj.rect.collidepoint(x,y)]
+        result = self.static_index.query_point(x, y)
+        result.extend([obj for obj in self._dynamic_entities if obj.rect.collidepoint(x,y)])
+        result.sort(key=self._sort_key)
+        return result
+        
+    def get_objects_in_rect(self, rect, include_static=True):
+        "returns the entities overlapping rect, in entity_list order"
+        result = self.static_index.query(rect) if include_static else []
+        result.extend([obj for obj in self._dynamic_entities if obj.rect.colliderect(rect)])
+        result.sort(key=self._sort_key)
+        return result
         
     def bring_out_yer_dead(self):
         """Removes all dead non-player Boxes from the level. 
            Returns the list of removed items (and the player if the player
            is dead). """
-        dead = [x for x in self.entity_list if not x.alive() and x is not self.actor]
+        dead = [x for x in self.entity_list.take_dead() if not x.alive() and x is not self.actor]
         
         if len(dead) > 0:
-            self.entity_list = [x for x in self.entity_list if x not in dead]
+            dead.sort(key=self._sort_key)   # in entity_list order
+            for x in dead:
+                self.remove_object(x)
             
         if self.actor != None and not self.actor.is_alive:
             dead.append(self.actor)
@@ -87,7 +262,9 @@ class Level:
         if self.actor != None:
             new_actor.set_xy(self.actor.x(), self.actor.y()) 
         self.entity_list.remove(self.actor)
+        self._unindex_object(self.actor)
         self.entity_list.append(new_actor)
+        self._index_object(new_actor)
         self.actor = new_actor
     
     
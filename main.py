@@ -83,7 +83,7 @@ while still_running and gamestate_manager.still_running():
     gamestate_manager.update(dt)
     gamestate_manager.draw(screen)
 
-    pygame.display.flip()
+    platformer_inst.drawer.present()
     clock.tick(FPS)
     
     #ticks += 1
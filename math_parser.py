@@ -1,6 +1,16 @@
+import ast
+import collections
+import functools
 import math
+import operator
+import sys
 import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 EMDAS = [
     ('+', lambda a, b: lambda s: a(s) + b(s)),
@@ -25,6 +35,39 @@ SCOPE = {
 }
 
 
+# How compile_function compiles the operators in EMDAS, and how it folds them when both sides are constant
+AST_OPERATORS = {
+    '+': (ast.Add, operator.add),
+    '-': (ast.Sub, operator.sub),
+    '*': (ast.Mult, operator.mul),
+    '/': (ast.Div, operator.truediv),
+    '**': (ast.Pow, operator.pow),
+}
+
+
+# The functions compiled code calls directly, instead of going through SCOPE's wrappers
+NATIVE_FUNCTIONS = {
+    'sin': math.sin,
+    'cos': math.cos,
+    'abs': abs,
+    'max': max,
+    'min': min,
+}
+
+
+# What compile_vector_function's code calls instead, so that it works on whole arrays of values
+if numpy != None:
+    VECTOR_FUNCTIONS = {
+        'sin': numpy.sin,
+        'cos': numpy.cos,
+        'abs': numpy.abs,
+        'max': lambda args: functools.reduce(numpy.maximum, args),
+        'min': lambda args: functools.reduce(numpy.minimum, args),
+        'step': lambda a, b: numpy.where(b >= a, 1, 0),
+        'power': numpy.power,
+    }
+
+
 class MalformedException(Exception):
     pass
 
@@ -157,6 +200,381 @@ def pythonify(string):
     return evaluate
 
 
+def compile_tree(tree, args, vectorized=False):
+    """Like expression, but returns a Python ast node that does the same operations in the same 
+    order (so it gives exactly the same results), with constant subexpressions folded. Names that 
+    aren't in args or SCOPE raise a MalformedException. If vectorized, the node calls the functions
+    in VECTOR_FUNCTIONS instead of NATIVE_FUNCTIONS, and works on arrays."""
+    if not isinstance(tree, list):
+        try:
+            return ast.Constant(float(tree))
+        except:
+            if tree in args:
+                return ast.Name(tree, ast.Load())
+            elif tree in SCOPE and not isinstance(SCOPE[tree], tuple):
+                return ast.Constant(SCOPE[tree])
+            raise MalformedException('Unknown name in expression', tree)
+
+    if len(tree) == 1:
+        return compile_tree(tree[0], args, vectorized)
+    for (op, _) in EMDAS:
+        if op in tree:
+            i = tree.index(op)
+            l = tree[:i]
+            r = tree[i+1:]
+
+            if l == [] and op == '-':
+                return fold(ast.BinOp(ast.Constant(-1), ast.Mult(), compile_tree(r, args, vectorized)))
+
+            node = fold(ast.BinOp(
+                compile_tree(l, args, vectorized),
+                AST_OPERATORS[op][0](),
+                compile_tree(r, args, vectorized),
+            ))
+            if vectorized and isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+                node = ast.Call(ast.Name('power', ast.Load()), [node.left, node.right], [])
+            return node
+
+    # Handles function calls
+    if len(tree) == 2:
+        fname = tree[0]
+        if isinstance(fname, list) or not isinstance(SCOPE.get(fname), tuple):
+            raise MalformedException('Unknown function in expression', tree)
+        _, min_args, max_args = SCOPE[fname]
+        call_args = [compile_tree(arg, args, vectorized) for arg in comma_split(tree[1])]
+        if (min_args and len(call_args) < min_args) or (max_args and len(call_args) > max_args):
+            raise MalformedException(
+                'Wrong number of arguments in function call',
+                tree
+            )
+
+        if fname == 'step' and not vectorized:
+            return fold(ast.IfExp(
+                ast.Compare(call_args[1], [ast.GtE()], [call_args[0]]),
+                ast.Constant(1),
+                ast.Constant(0),
+            ))
+        elif fname == 'max' or fname == 'min':
+            call_args = [ast.Tuple(call_args, ast.Load())]
+        return fold(ast.Call(ast.Name(fname, ast.Load()), call_args, []))
+
+    # No pattern was matched, so the rest of the tree can't be parsed
+    raise MalformedException('Unable to parse expression', tree)
+
+
+def fold(node):
+    "Replaces an operation on constants with its result, unless computing it raises an error"
+    try:
+        if isinstance(node, ast.BinOp):
+            if isinstance(node.left, ast.Constant) and isinstance(node.right, ast.Constant):
+                for (ast_op, op) in AST_OPERATORS.values():
+                    if isinstance(node.op, ast_op):
+                        return ast.Constant(op(node.left.value, node.right.value))
+        elif isinstance(node, ast.IfExp):
+            compare = node.test
+            if isinstance(compare.left, ast.Constant) and isinstance(compare.comparators[0], ast.Constant):
+                return ast.Constant(1 if compare.left.value >= compare.comparators[0].value else 0)
+        elif isinstance(node, ast.Call):
+            values = node.args[0].elts if isinstance(node.args[0], ast.Tuple) else node.args
+            if all(isinstance(x, ast.Constant) for x in values):
+                return ast.Constant(SCOPE[node.func.id][0]([x.value for x in values]))
+    except (ArithmeticError, ValueError, TypeError):
+        pass    # leave it to raise when the function's called, like the lambda evaluator does
+    return node
+
+
+def compile_function(string, args=('t',)):
+    """Returns a plain Python function of args that evaluates the given expression
+    string. It's compiled to bytecode, with constant subexpressions folded and the
+    functions it calls bound as closure variables, so it's much faster than the
+    function pythonify returns but gives exactly the same results.
+
+    Raises a MalformedException if the expression is malformed or uses a name that
+    isn't one of args or a built-in constant.
+
+    >>> compile_function('t*2 + 1')(3)
+    7.0
+    >>> compile_function('max(x, y)', args=('x', 'y'))(1, 2)
+    2
+    """
+    body = compile_tree(parse_tree(string), args)
+    return compile_body(body, args, NATIVE_FUNCTIONS, string)
+
+
+def compile_vector_function(strings, args=('t',)):
+    """Like compile_function, but the function works on NumPy arrays (or anything 
+    numpy.asarray takes) of values for args, and returns a float array of the expression's 
+    value for each of them, broadcast together. strings can also be a list of expressions 
+    that all take the same arrays, and then they're all evaluated in one call, which returns 
+    an array with a row for each of them. Requires numpy.
+
+    >>> compile_vector_function('t*2 + 1')([0, 1, 2])
+    array([1., 3., 5.])
+    >>> compile_vector_function(['t', 'max(t, 1)'])([0, 2])
+    array([[0., 2.],
+           [1., 2.]])
+    """
+    single = isinstance(strings, str)
+    if single:
+        strings = [strings]
+    bodies = [compile_tree(parse_tree(string), args, vectorized=True) for string in strings]
+    compiled = compile_body(ast.Tuple(bodies, ast.Load()), args, VECTOR_FUNCTIONS, ', '.join(strings))
+
+    n_rows = len(bodies)
+
+    def evaluate(*values):
+        values = [numpy.asarray(x, dtype=float) for x in values]
+        result = numpy.empty((n_rows,) + numpy.broadcast_shapes(*[x.shape for x in values]))
+        for (row, value) in zip(result, compiled(*values)):
+            row[...] = value
+        return result[0] if single else result
+    return evaluate
+
+
+def differentiate(node, var):
+    """Returns an ast node for the derivative of node (made by compile_tree) with respect 
+    to var, simplified and with constants folded. Where abs, max and min aren't 
+    differentiable it takes the derivative of the side they pick. Raises a 
+    MalformedException for u**v where both depend on var, which would need a log."""
+    if isinstance(node, ast.Constant):
+        return ast.Constant(0.0)
+    elif isinstance(node, ast.Name):
+        return ast.Constant(1.0 if node.id == var else 0.0)
+    elif isinstance(node, ast.IfExp):     # step, which is flat on both sides
+        return ast.Constant(0.0)
+    elif isinstance(node, ast.BinOp):
+        u, v = node.left, node.right
+        du, dv = differentiate(u, var), differentiate(v, var)
+        if isinstance(node.op, ast.Add):
+            return _sum(du, dv)
+        elif isinstance(node.op, ast.Sub):
+            return _difference(du, dv)
+        elif isinstance(node.op, ast.Mult):
+            return _sum(_product(du, v), _product(u, dv))
+        elif isinstance(node.op, ast.Div):
+            return _quotient(_difference(_product(du, v), _product(u, dv)), _product(v, v))
+        elif _is_constant(dv, 0):
+            return _product(_product(v, fold(ast.BinOp(u, ast.Pow(), _difference(v, ast.Constant(1.0))))), du)
+        elif isinstance(u, ast.Constant) and u.value > 0:
+            return _product(_product(node, ast.Constant(math.log(u.value))), dv)
+        raise MalformedException('Unable to differentiate expression', ast.unparse(node))
+    elif isinstance(node, ast.Call):
+        fname = node.func.id
+        if fname == 'max' or fname == 'min':
+            (first, *rest) = node.args[0].elts
+            if len(rest) == 0:
+                return differentiate(first, var)
+            rest = rest[0] if len(rest) == 1 else ast.Call(node.func, [ast.Tuple(rest, ast.Load())], [])
+            picks_first = ast.Compare(first, [ast.GtE() if fname == 'max' else ast.LtE()], [rest])
+            return ast.IfExp(picks_first, differentiate(first, var), differentiate(rest, var))
+        u = node.args[0]
+        du = differentiate(u, var)
+        if fname == 'sin':
+            return _product(ast.Call(ast.Name('cos', ast.Load()), [u], []), du)
+        elif fname == 'cos':
+            return _product(_product(ast.Constant(-1.0), ast.Call(ast.Name('sin', ast.Load()), [u], [])), du)
+        elif fname == 'abs':
+            sign = ast.IfExp(ast.Compare(u, [ast.GtE()], [ast.Constant(0)]), ast.Constant(1.0), ast.Constant(-1.0))
+            return _product(fold(sign), du)
+    raise MalformedException('Unable to differentiate expression', ast.unparse(node))
+
+
+def _is_constant(node, value):
+    return isinstance(node, ast.Constant) and node.value == value
+
+
+def _sum(a, b):
+    if _is_constant(a, 0):
+        return b
+    elif _is_constant(b, 0):
+        return a
+    return fold(ast.BinOp(a, ast.Add(), b))
+
+
+def _difference(a, b):
+    if _is_constant(b, 0):
+        return a
+    elif _is_constant(a, 0):
+        return _product(ast.Constant(-1.0), b)
+    return fold(ast.BinOp(a, ast.Sub(), b))
+
+
+def _product(a, b):
+    if _is_constant(a, 0) or _is_constant(b, 0):
+        return ast.Constant(0.0)
+    elif _is_constant(a, 1):
+        return b
+    elif _is_constant(b, 1):
+        return a
+    return fold(ast.BinOp(a, ast.Mult(), b))
+
+
+def _quotient(a, b):
+    if _is_constant(a, 0):
+        return ast.Constant(0.0)
+    elif _is_constant(b, 1):
+        return a
+    return fold(ast.BinOp(a, ast.Div(), b))
+
+
+def compile_derivative(string, var='t', args=('t',)):
+    """Returns a plain Python function of args that evaluates the derivative of the 
+    given expression string with respect to var, compiled like compile_function.
+
+    >>> compile_derivative('3*t**2 + sin(t)')(0)
+    1.0
+    """
+    node = differentiate(compile_tree(parse_tree(string), args), var)
+    return compile_body(node, args, NATIVE_FUNCTIONS, 'd/d' + var + ' ' + string)
+
+
+def compile_body(body, args, functions, string):
+    "Compiles an ast expression node into a function of args, with functions bound as closure variables"
+    arguments = lambda names: ast.arguments(
+        posonlyargs=[], args=[ast.arg(name) for name in names], kwonlyargs=[], kw_defaults=[], defaults=[])
+    function = ast.FunctionDef(
+        name='compiled', args=arguments(args), body=[ast.Return(body)], decorator_list=[])
+    factory = ast.FunctionDef(
+        name='factory', args=arguments(functions.keys()),
+        body=[function, ast.Return(ast.Name('compiled', ast.Load()))], decorator_list=[])
+    module = ast.Module(body=[factory], type_ignores=[])
+    ast.fix_missing_locations(module)
+
+    namespace = {}
+    exec(compile(module, '<expression ' + string + '>', 'exec'), namespace)
+    return namespace['factory'](**functions)
+
+
+def normalize(string):
+    """Returns the expression's tokens separated by single spaces, which parse_tree 
+    turns into the same tree as the expression itself, so expressions that only differ 
+    in spacing normalize to the same text.
+
+    >>> normalize('352 + (32*sin( 0.04 * t))')
+    '352 + (32 * sin( 0.04 * t))'
+    """
+    return ' '.join(token for token in badfix(string).split(' ') if token)
+
+
+def approximate_size(value):
+    """Roughly how many bytes value takes up, counting a function's code, constants 
+    and the functions it closes over, and an object's attributes"""
+    size = sys.getsizeof(value)
+    code = getattr(value, '__code__', None)
+    if code != None:
+        size += sys.getsizeof(code) + sum(sys.getsizeof(x) for x in code.co_consts)
+        for cell in value.__closure__ or ():
+            size += sys.getsizeof(cell)
+            if hasattr(cell.cell_contents, '__code__'):
+                size += approximate_size(cell.cell_contents)
+    elif hasattr(value, '__dict__'):
+        size += sys.getsizeof(value.__dict__) + sum(approximate_size(x) for x in value.__dict__.values())
+    return size
+
+
+CACHES = []     # every ExpressionCache, for cache_stats
+
+
+class ExpressionCache:
+    """A process wide, size bounded, least recently used cache of whatever compile_many
+    makes from expressions, keyed by their normalized text. Keys are expression strings,
+    or tuples of them. compile_many is given a list of normalized keys that missed and
+    returns a list of their values, so the misses of a get_many are compiled in one batch."""
+
+    def __init__(self, name, compile_many, max_size=256):
+        self.name = name
+        self.compile_many = compile_many
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()    # normalized key -> (value, approximate size)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.memory = 0
+        CACHES.append(self)
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        keys = [normalize(key) if isinstance(key, str) else tuple(normalize(x) for x in key) for key in keys]
+        missing = [key for key in dict.fromkeys(keys) if key not in self._entries]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        found = {}
+        for key in keys:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                found[key] = self._entries[key][0]
+        if len(missing) > 0:
+            for (key, value) in zip(missing, self.compile_many(missing)):
+                found[key] = value
+                self._add(key, value)
+        return [found[key] for key in keys]
+
+    def _add(self, key, value):
+        size = approximate_size(value) + approximate_size(key)
+        self._entries[key] = (value, size)
+        self.memory += size
+        while len(self._entries) > self.max_size:
+            (_, (_, old_size)) = self._entries.popitem(last=False)
+            self.memory -= old_size
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.memory = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+            'memory': self.memory,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def cache_stats():
+    """Returns each ExpressionCache's name mapped to its stats: its size, hits, misses,
+    evictions, hit rate and approximate memory use in bytes"""
+    return {cache.name: cache.stats() for cache in CACHES}
+
+
+FUNCTION_CACHE = ExpressionCache(
+    'functions', lambda strings: [compile_function(x) for x in strings], max_size=256)
+VECTOR_FUNCTION_CACHE = ExpressionCache(
+    'vector functions', lambda keys: [compile_vector_function(list(x)) for x in keys], max_size=32)
+
+
+DERIVATIVE_CACHE = ExpressionCache(
+    'derivatives', lambda strings: [_derivative_or_none(x) for x in strings], max_size=256)
+
+
+def cached_function(string):
+    """Returns compile_function(string), for t, from FUNCTION_CACHE, so expressions
+    that only differ in spacing share one function and are only parsed once"""
+    return FUNCTION_CACHE.get(string)
+
+
+def cached_derivative(string):
+    """Returns compile_derivative(string), the derivative with respect to t, from
+    DERIVATIVE_CACHE, or None if the expression can't be differentiated"""
+    return DERIVATIVE_CACHE.get(string)
+
+
+def _derivative_or_none(string):
+    try:
+        return compile_derivative(string)
+    except MalformedException:
+        return None
+
+
 class ParserTest(unittest.TestCase):
     EPS = 0.000001
 
@@ -187,9 +605,53 @@ class ParserTest(unittest.TestCase):
         self.do_test("496 - 48*sin(0)", 496)
         self.do_test("496 - 48*sin(t)", 496, t_val=0)
 
+    def test_compiled(self):
+        for t in (0, 1, 2.5, 17, 100):
+            for expression in ("496 - (48*sin(0.04*t))", "80 + -48*sin(0.02*t)", "448 + 128*sin(t*0.03 + pi*4/3)",
+                    "1792 + 160*(cos(0.02*t))", "max(t, 3, min(t/2, 5)) - abs(-t) + step(10, t)", "2-7+t-1", "t**2/3*4"):
+                self.assertEqual(pythonify(expression)(t=t), compile_function(expression)(t))
+        self.assertIn(6.0, compile_function("2*3 + t").__code__.co_consts)
+        self.assertRaises(MalformedException, compile_function, "x + 1")
+
+    def test_cache(self):
+        cache = ExpressionCache('test', lambda strings: [compile_function(x) for x in strings], max_size=2)
+        CACHES.remove(cache)
+        f = cache.get("0.02*t")
+        self.assertIs(f, cache.get("0.02 * t"))
+        self.assertEqual(0.04, f(2))
+        cache.get_many(["t", "1 + t", "t"])
+        self.assertEqual(2, len(cache))
+        self.assertIsNot(f, cache.get("0.02*t"))   # evicted
+        stats = cache.stats()
+        self.assertEqual((2, 4, 2), (stats['hits'], stats['misses'], stats['evictions']))
+        self.assertGreater(stats['memory'], 0)
+
+    def test_derivative(self):
+        expressions = ["496 - (48*sin(0.04*t))", "80 + -48*sin(0.02*t)", "448 + 128*sin(t*0.03 + pi*4/3)",
+                "1792 + 160*(cos(0.02*t))", "max(t, 30, min(t/2, 50)) - abs(10 - t) + step(10, t)", 
+                "2-7+t-1", "t**2/3*4", "t/(t + 1)", "2**(t/10)", "352"]
+        h = 1e-6
+        for expression in expressions:
+            f = compile_function(expression)
+            derivative = compile_derivative(expression)
+            for t in (1.5, 17.25, 42.75, 100.5):
+                self.assertAlmostEqual((f(t + h) - f(t - h)) / (2*h), derivative(t), delta=1e-4)
+        self.assertRaises(MalformedException, compile_derivative, "t**t")
+        self.assertEqual(None, cached_derivative("t**(t/2)"))
+
+    @unittest.skipIf(numpy is None, "numpy isn't installed")
+    def test_vectorized(self):
+        expressions = ["496 - (48*sin(0.04*t))", "80 + -48*sin(0.02*t)", "448 + 128*sin(t*0.03 + pi*4/3)",
+                "max(t, 3, min(t/2, 5)) - abs(-t) + step(10, t)", "2-7+t-1", "t**2/3*4", "352"]
+        times = [0, 1, 2.5, 17, 100]
+        expected = [[pythonify(x)(t=t) for t in times] for x in expressions]
+        self.assertEqual(expected, compile_vector_function(expressions)(numpy.array(times)).tolist())
+        self.assertEqual(expected[0], compile_vector_function(expressions[0])(times).tolist())
+
     def do_test(self, expression, expected, t_val=0):
         actual = pythonify(expression)(t=t_val)
         self.assertAlmostEqual(expected, actual, delta=ParserTest.EPS)
+        self.assertEqual(actual, compile_function(expression)(t_val))
 
 if __name__ == "__main__":
     unittest.main()
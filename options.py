@@ -65,6 +65,10 @@ class Settings:
         self._invincible_mode = False
         self._frozen_mode = False  
         self._draw_3d = self._get_attribute("add_whole_new_dimension_of_gameplay")
+        self._collision_backend = self._get_attribute("collision_backend")
+        self._continuous_collisions = self._get_attribute("continuous_collisions")
+        self._activation_regions = self._get_attribute("activation_regions")
+        self._dirty_rects = self._get_attribute("dirty_rects")
         
         self._single_level_mode = False
         self._single_level_num = -1
@@ -99,6 +103,25 @@ class Settings:
         return self._edit_mode
     def set_draw_3d(self, val):
         self._draw_3d = val
+    def collision_backend(self):
+        "python or numpy"
+        return self._collision_backend
+    def set_collision_backend(self, val):
+        self._collision_backend = val
+    def continuous_collisions(self):
+        return self._continuous_collisions
+    def set_continuous_collisions(self, val):
+        self._continuous_collisions = val
+    def activation_regions(self):
+        "whether far away enemies and moving blocks are updated less often, see activation.ActivationScheduler"
+        return self._activation_regions
+    def set_activation_regions(self, val):
+        self._activation_regions = val
+    def dirty_rects(self):
+        "whether only the parts of the screen that changed are repainted and presented, see drawing.DirtyRects"
+        return self._dirty_rects
+    def set_dirty_rects(self, val):
+        self._dirty_rects = val
     def set_edit_mode(self, val):
         self._edit_mode = val
     def set_show_grid(self, val):
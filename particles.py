@@ -0,0 +1,233 @@
+import math
+from array import array
+
+import pygame
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import blocks
+
+class ParticleEmitter:
+    """Short lived particles such as blood, which only ever fall and bump into a level's static
+       geometry. They aren't entities. Their positions, velocities, lifespans and colors live in flat
+       arrays, every particle is stepped in one pass over those arrays (vectorized if numpy is
+       installed), and they're drawn with a single blits call, so bursts of thousands of them stay cheap."""
+    FIELDS = ("x", "y", "vx", "vy", "lifespan")
+    GRAVITY = 0.3
+    MAX_VX = 5
+    MAX_VY = 15
+    FRICTION = 0.95     # applied to vx whenever a particle is barely moving vertically
+
+    def __init__(self, size=10, collision_mask=blocks.LAYER_TERRAIN):
+        self.size = size
+        self.collision_layer = blocks.LAYER_PARTICLE
+        self.collision_mask = collision_mask
+        for field in ParticleEmitter.FIELDS:
+            setattr(self, field, array("d"))
+        self.colors = []
+        self._surfaces = {}     # color -> a particle sized surface filled with it
+        self._tile_sums = {}    # occupancy group -> (its tiles, summed area table of its non empty tiles)
+
+    def emit(self, x, y, v, color, lifespan=100):
+        self.x.append(x)
+        self.y.append(y)
+        self.vx.append(v[0])
+        self.vy.append(v[1])
+        self.lifespan.append(lifespan)
+        self.colors.append(tuple(color))
+
+    def clear(self):
+        for field in ParticleEmitter.FIELDS:
+            del getattr(self, field)[:]
+        self.colors = []
+
+    def update(self, dt, occupancy=None):
+        """Steps every particle, stopping them against the solid static blocks in occupancy
+           (a spatial.OccupancyMap) and removing the ones whose lifespan has run out."""
+        if dt == 0 or len(self.colors) == 0:
+            return
+        groups = None
+        if occupancy != None:
+            groups = [(layer, mask) for (layer, mask) in occupancy.groups() if (self.collision_mask & layer) != 0 and (mask & self.collision_layer) != 0]
+            if len(groups) == 0:
+                occupancy = None
+        if numpy is None:
+            n_dead = self._update_python(dt, occupancy, groups)
+        else:
+            n_dead = self._update_numpy(dt, occupancy, groups)
+        if n_dead > 0:
+            self._remove_dead()
+
+    def _update_python(self, dt, occupancy, groups):
+        xs, ys, vxs, vys, lifespans = self.x, self.y, self.vx, self.vy, self.lifespan
+        gravity = ParticleEmitter.GRAVITY*dt
+        max_vx = ParticleEmitter.MAX_VX
+        max_vy = ParticleEmitter.MAX_VY
+        friction = ParticleEmitter.FRICTION
+        n_dead = 0
+        for i in range(len(xs)):
+            life = lifespans[i] - dt
+            lifespans[i] = life
+            if life <= 0:
+                n_dead += 1
+                continue
+            vx = min(max(vxs[i], -max_vx), max_vx)
+            vy = min(max(vys[i] + gravity, -max_vy), max_vy)
+            x = xs[i]
+            y = ys[i]
+            new_x = x + vx*dt
+            new_y = y + vy*dt
+            if occupancy != None:
+                (new_x, new_y, vx, vy) = self._collide(x, y, new_x, new_y, vx, vy, dt, occupancy, groups)
+            if abs(vy) < 1:
+                vx *= friction
+            xs[i] = new_x
+            ys[i] = new_y
+            vxs[i] = vx
+            vys[i] = vy
+        return n_dead
+
+    def _update_numpy(self, dt, occupancy, groups):
+        "same as _update_python, but only the particles that might hit something are stepped one at a time"
+        x, y, vx, vy, lifespan = [numpy.frombuffer(getattr(self, field)) for field in ParticleEmitter.FIELDS]
+        lifespan -= dt
+        alive = lifespan > 0
+        new_vx = numpy.clip(vx, -ParticleEmitter.MAX_VX, ParticleEmitter.MAX_VX)
+        new_vy = numpy.clip(vy + ParticleEmitter.GRAVITY*dt, -ParticleEmitter.MAX_VY, ParticleEmitter.MAX_VY)
+        new_x = x + new_vx*dt
+        new_y = y + new_vy*dt
+
+        if occupancy != None:
+            moved = (numpy.floor(new_x) != numpy.floor(x)) | (numpy.floor(new_y) != numpy.floor(y))
+            suspects = numpy.flatnonzero(alive & moved & self._near_occupied(x, y, new_x, new_y, occupancy, groups))
+            columns = [a[suspects].tolist() for a in (x, y, new_x, new_y, new_vx, new_vy)]
+            for (i, args) in zip(suspects.tolist(), zip(*columns)):
+                (new_x[i], new_y[i], new_vx[i], new_vy[i]) = self._collide(*args, dt, occupancy, groups)
+
+        new_vx = numpy.where(numpy.abs(new_vy) < 1, new_vx*ParticleEmitter.FRICTION, new_vx)
+        x[alive] = new_x[alive]
+        y[alive] = new_y[alive]
+        vx[alive] = new_vx[alive]
+        vy[alive] = new_vy[alive]
+        n_dead = len(alive) - int(numpy.count_nonzero(alive))
+        del x, y, vx, vy, lifespan     # the arrays can't be replaced while numpy views of them exist
+        return n_dead
+
+    def _near_occupied(self, x, y, new_x, new_y, occupancy, groups):
+        """for each particle, whether any tile touched by its move from (x, y) to (new_x, new_y) isn't empty.
+           The rest can't hit anything this step."""
+        size = self.size
+        tile_size = occupancy.tile_size
+        x1 = numpy.floor(numpy.minimum(x, new_x)).astype(numpy.int64)
+        y1 = numpy.floor(numpy.minimum(y, new_y)).astype(numpy.int64)
+        x2 = numpy.floor(numpy.maximum(x, new_x)).astype(numpy.int64) + size - 1
+        y2 = numpy.floor(numpy.maximum(y, new_y)).astype(numpy.int64) + size - 1
+        result = numpy.zeros(len(x), dtype=bool)
+        for group in groups:
+            (tile_x, tile_y, cols, rows, sums) = self._summed_tiles(occupancy, group)
+            tx1 = numpy.maximum(x1 // tile_size - tile_x, 0)
+            ty1 = numpy.maximum(y1 // tile_size - tile_y, 0)
+            tx2 = numpy.minimum(x2 // tile_size - tile_x, cols - 1)
+            ty2 = numpy.minimum(y2 // tile_size - tile_y, rows - 1)
+            inside = (tx1 <= tx2) & (ty1 <= ty2)
+            tx1 = numpy.where(inside, tx1, 0)
+            ty1 = numpy.where(inside, ty1, 0)
+            tx2 = numpy.where(inside, tx2, 0)
+            ty2 = numpy.where(inside, ty2, 0)
+            count = sums[ty2 + 1, tx2 + 1] - sums[ty1, tx2 + 1] - sums[ty2 + 1, tx1] + sums[ty1, tx1]
+            result |= inside & (count > 0)
+        return result
+
+    def _summed_tiles(self, occupancy, group):
+        "the group's tiles, with a summed area table of its non empty ones, rebuilt whenever the map is"
+        (tile_x, tile_y, cols, rows, tiles) = occupancy.tiles(group)
+        if group not in self._tile_sums or self._tile_sums[group][0] is not tiles:
+            occupied = (numpy.frombuffer(tiles, dtype=numpy.uint8).reshape(rows, cols) != 0).astype(numpy.int32)
+            sums = numpy.zeros((rows + 1, cols + 1), dtype=numpy.int32)
+            sums[1:, 1:] = occupied.cumsum(axis=0).cumsum(axis=1)
+            self._tile_sums[group] = (tiles, sums)
+        return (tile_x, tile_y, cols, rows, self._tile_sums[group][1])
+
+    def _collide(self, x, y, new_x, new_y, vx, vy, dt, occupancy, groups):
+        """moves a particle from (x, y) towards (new_x, new_y) one axis at a time, stopping it on the
+           axes where it would overlap occupancy. Returns the new (x, y, vx, vy)."""
+        size = self.size
+        floor = math.floor
+        left = floor(new_x)     # only probed when a move reaches a new pixel, the old one's known to be clear
+        top = floor(y)
+        if left != floor(x) and occupancy.overlaps(left, top, left + size, top + size, groups):
+            new_x = self._approach(occupancy, groups, x, top, vx*dt, True)
+            vx = 0
+        left = floor(new_x)
+        top = floor(new_y)
+        if top != floor(y) and occupancy.overlaps(left, top, left + size, top + size, groups):
+            new_y = self._approach(occupancy, groups, y, left, vy*dt, False)
+            vy = 0
+        return (new_x, new_y, vx, vy)
+
+    def _approach(self, occupancy, groups, start, other, d, horizontal):
+        """moves from start towards start + d a pixel at a time, and returns the last position before the
+           particle would overlap anything, flush against what it hit"""
+        size = self.size
+        step = 1 if d > 0 else -1
+        pos = math.floor(start)
+        end = math.floor(start + d)
+        while pos != end:
+            edge = pos + step
+            if horizontal:
+                blocked = occupancy.overlaps(edge, other, edge + size, other + size, groups)
+            else:
+                blocked = occupancy.overlaps(other, edge, other + size, edge + size, groups)
+            if blocked:
+                break
+            pos = edge
+        return float(pos)
+
+    def _remove_dead(self):
+        alive = [i for (i, life) in enumerate(self.lifespan) if life > 0]
+        for field in ParticleEmitter.FIELDS:
+            values = getattr(self, field)
+            setattr(self, field, array("d", [values[i] for i in alive]))
+        self.colors = [self.colors[i] for i in alive]
+
+    def bounds(self):
+        "the rect in game coordinates that every particle is drawn inside, or None if there aren't any"
+        if len(self.colors) == 0:
+            return None
+        left = int(math.floor(min(self.x)))
+        top = int(math.floor(min(self.y)))
+        right = int(math.ceil(max(self.x))) + self.size
+        bottom = int(math.ceil(max(self.y))) + self.size
+        return pygame.Rect(left, top, right - left, bottom - top)
+
+    def in_rect(self, rect):
+        "(pygame.Rect, color) for each particle overlapping rect, all in game coordinates"
+        size = self.size
+        return [(pygame.Rect(int(x), int(y), size, size), color) for (x, y, color) in zip(self.x, self.y, self.colors) 
+                if x + size > rect.left and x < rect.right and y + size > rect.top and y < rect.bottom]
+
+    def draw(self, screen, camera_pos):
+        "draws every onscreen particle in one batched blit"
+        size = self.size
+        cam_x, cam_y = camera_pos
+        width = screen.get_width()
+        height = screen.get_height()
+        surfaces = self._surfaces
+        to_blit = []
+        for (x, y, color) in zip(self.x, self.y, self.colors):
+            screen_x = int(x - cam_x)
+            screen_y = int(y - cam_y)
+            if screen_x < -size or screen_y < -size or screen_x >= width or screen_y >= height:
+                continue
+            if color not in surfaces:
+                surfaces[color] = pygame.Surface((size, size))
+                surfaces[color].fill(color)
+            to_blit.append((surfaces[color], (screen_x, screen_y)))
+        if len(to_blit) > 0:
+            screen.blits(to_blit, False)
+
+    def __len__(self):
+        return len(self.colors)
@@ -1,27 +1,59 @@
 import math
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import math_parser
 
+MAX_TABLE_PERIOD = 4096             # longest period, in ticks, that build_tables makes a table for
+TABLE_HORIZON = 60 * 60 * 10        # how many ticks a function path's table is checked against the path for
+
+# (x expression, y expression) -> the function path's TrajectoryTable or None, so reloading a level 
+# doesn't look for the periods again
+TABLE_CACHE = math_parser.ExpressionCache('trajectory tables', lambda keys: _function_tables(keys), max_size=64)
+
 class Path:
     def __init__(self, x_path_string, y_path_string):
         self.t = 0;
         self.path_strings = (x_path_string, y_path_string) # used for serialization
-        self.x_fun = math_parser.pythonify(x_path_string)
-        self.y_fun = math_parser.pythonify(y_path_string)
+        self.x_fun = math_parser.cached_function(x_path_string)
+        self.y_fun = math_parser.cached_function(y_path_string)
+        self.dx_fun = math_parser.cached_derivative(x_path_string)     # None if it can't be differentiated
+        self.dy_fun = math_parser.cached_derivative(y_path_string)
+        self.table = None   # a TrajectoryTable, if build_tables found one
         
     def get_xy(self, time=None):
         if time == None:
             time = self.t
-        x = self.x_fun(t=time)
-        y = self.y_fun(t=time)
+        if self.table != None:
+            xy = self.table.get(time)
+            if xy != None:
+                return xy
+        x = self.x_fun(time)
+        y = self.y_fun(time)
         
         # rounding
         x = int(x + 0.5) 
         y = int(y + 0.5)
         return (x,y)
         
+    def get_velocity(self, time=None):
+        "the exact (unrounded) velocity along the path at time, from its derivative, or None if it hasn't got one"
+        if time == None:
+            time = self.t
+        if self.dx_fun == None or self.dy_fun == None:
+            return None
+        return (self.dx_fun(time), self.dy_fun(time))
+        
     def step(self, dt):
         self.t += dt
+        
+    def get_polyline(self, start_t=0, end_t=360, step=30):
+        "the path's position every step ticks from start_t up to end_t"
+        return polylines([self], start_t, end_t, step)[0]
             
     def to_json(self):
         return {
@@ -35,6 +67,9 @@ class Path:
         
         
 class PointPath(Path):  
+    """Moves back and forth through a loop of points, easing in and out of each one. Each segment 
+       takes segment_duration ticks, and where the path is is a pure function of time, so get_xy 
+       works for any t and stepping any distance ahead is O(1)."""
     def __init__(self, x_points, y_points, speed=3, offset=0):
         self.x_points = x_points
         self.y_points = y_points
@@ -44,52 +79,71 @@ class PointPath(Path):
         if len(self.x_points) < 2 or len(self.y_points) < 2 or len(self.x_points) != len(self.y_points):
             raise ValueError("Path given arrays of invalid lengths: x_points="+str(len(self.x_points))+", y_points="+str(len(self.y_points)))
         
-        start = offset % len(self.x_points)
-        next = (offset + 1) % len(self.x_points)
-        Path.__init__(self, 
-                self.get_spline_string(self.x_points[start], self.x_points[next]), 
-                self.get_spline_string(self.y_points[start], self.y_points[next]))
-        self.dest_index = next
-        self.at_end_of_spline = False
+        self.t = 0
+        self.table = None
+        self.rate = self.speed * 0.01   # the easing goes from 0 to 1 as t*rate goes from 0 to pi
+        
+        # A segment ends on the first whole tick past pi / rate, and the block sits exactly on 
+        # the segment's last point for that tick.
+        duration = int(math.pi / self.rate) + 1
+        while duration > 1 and self.rate * (duration - 1) > math.pi:
+            duration -= 1
+        while not self.rate * duration > math.pi:
+            duration += 1
+        self.segment_duration = duration
+        
+        # (x, y, half of dx, half of dy, start time) of each segment, in the order they're traveled
+        n = len(self.x_points)
+        self._segments = []
+        for i in range(n):
+            start = (offset + i) % n
+            dest = (start + 1) % n
+            self._segments.append((self.x_points[start], self.y_points[start], 
+                    (self.x_points[dest] - self.x_points[start]) / 2, (self.y_points[dest] - self.y_points[start]) / 2, 
+                    i * duration))
+        self.period = n * duration
         
     def get_xy(self, time=None):
-        if time != None:
-            raise NotImplementedError("can't supply time arg for PointPath")
-        if self.at_end_of_spline:
-            return (self.x_points[self.dest_index], self.y_points[self.dest_index])
+        if time == None:
+            time = self.t
+        if self.table != None:
+            xy = self.table.get(time)
+            if xy != None:
+                return xy
+        if time <= 0:
+            index = 0
+            local_t = 0
         else:
-            return Path.get_xy(self)
+            index = int(math.ceil(time / self.segment_duration)) - 1
+            local_t = time - index * self.segment_duration
+            index = index % len(self._segments)
+        x, y, half_dx, half_dy, _ = self._segments[index]
+        if self.rate * local_t > math.pi:   # at the end of the segment
+            x, y, _, _, _ = self._segments[(index + 1) % len(self._segments)]
+            return (x, y)
+        ease = 1 - math.cos(local_t * self.rate)
+        return (int(x + half_dx * ease + 0.5), int(y + half_dy * ease + 0.5))
+        
+    def get_velocity(self, time=None):
+        "the exact (unrounded) velocity along the path at time, the derivative of get_xy's easing"
+        if time == None:
+            time = self.t
+        if time <= 0:
+            return (0.0, 0.0)
+        index = int(math.ceil(time / self.segment_duration)) - 1
+        local_t = time - index * self.segment_duration
+        if self.rate * local_t > math.pi:
+            return (0.0, 0.0)
+        _, _, half_dx, half_dy, _ = self._segments[index % len(self._segments)]
+        d_ease = self.rate * math.sin(local_t * self.rate)
+        return (half_dx * d_ease, half_dy * d_ease)
             
     def step(self, dt):
-        if self.at_end_of_spline:
-            #time to move to next spline
-            self.t = 0
-            self.dest_index = (self.dest_index + 1) % len(self.x_points)
-            
-            self.x_fun = math_parser.pythonify(self.get_spline_string(
-                    self.x_points[self.dest_index-1], 
-                    self.x_points[self.dest_index]))
-            self.y_fun = math_parser.pythonify(self.get_spline_string(
-                    self.y_points[self.dest_index-1], 
-                    self.y_points[self.dest_index]))
-                    
-            self.at_end_of_spline = False
-      
         self.t += dt
-        inner = self.speed * 0.01 * self.t
-        if inner > math.pi:
-            self.at_end_of_spline = True
         
-    def get_spline_string(self, x1, x2):
-        d = (x2 - x1)
-        x1 = str(x1)
-        if d == 0:
-            return x1
-        x2 = str(x2)
-        d = str(d)
-        speed = str(self.speed)
-        
-        return x1 + " + ("+d+"/2) * (1 - cos(t*" + speed + "*0.01))"
+    def get_polyline(self, start_t=0, end_t=360, step=30):
+        "the points in the order they're traveled, which is exactly the path (it's straight between them)"
+        return [self.get_xy(i * self.segment_duration) for i in range(len(self._segments))]
         
     def to_json(self):
         return {
@@ -104,6 +158,109 @@ class PointPath(Path):
     def is_point_path(self): return True
         
 
+class TrajectoryTable:
+    """The rounded positions of a path at every whole tick of one period, interleaved in an array('i'),
+       which get_xy looks up instead of evaluating the path. It's only used for the ticks from 1 up to 
+       horizon, which are the ones it's known to match the path for."""
+    def __init__(self, xs, ys, horizon=math.inf):
+        "xs and ys are the positions at ticks period, 1, 2, ... period - 1, so tick t's is at t % period"
+        self.period = len(xs)
+        self.horizon = horizon
+        self.xy = array("i", [value for xy in zip(xs, ys) for value in xy])
+        
+    def get(self, time):
+        "the position at time, or None if the table doesn't cover it"
+        if 1 <= time <= self.horizon:
+            tick = int(time)
+            if tick == time:
+                i = (tick % self.period) * 2
+                return (self.xy[i], self.xy[i + 1])
+        return None
+        
+def build_tables(path_list):
+    """Looks for the period of each of the paths' rounded positions, and gives each path that has one 
+       of at most MAX_TABLE_PERIOD ticks a TrajectoryTable. A point path's period is known exactly. A 
+       function path's is looked for by evaluating it over the first TABLE_HORIZON ticks (which needs 
+       numpy), and its table is only used up to there, since most trig paths don't repeat exactly 
+       (sin(0.04*t) repeats every 50*pi ticks) and eventually drift off any whole number period. Paths 
+       with the same expressions share a table from TABLE_CACHE. The rest are evaluated live."""
+    for path in path_list:
+        if path.is_point_path() and path.period <= MAX_TABLE_PERIOD:
+            ticks = [path.period] + list(range(1, path.period))
+            xys = [path.get_xy(t) for t in ticks]
+            path.table = _make_table([x for (x, _) in xys], [y for (_, y) in xys])
+            
+    if numpy == None:
+        return
+    funct_paths = [path for path in path_list if path.is_funct_path()]
+    for (path, table) in zip(funct_paths, TABLE_CACHE.get_many([path.path_strings for path in funct_paths])):
+        path.table = table
+        
+def _function_tables(string_pairs):
+    "the TrajectoryTable, or None, of each (x, y) expression pair's path, all evaluated in one batch"
+    rounded = _rounded_values(string_pairs, range(TABLE_HORIZON + 1))
+    result = []
+    for i in range(len(string_pairs)):
+        xys = rounded[2*i : 2*i + 2]
+        period = _find_period(xys, MAX_TABLE_PERIOD)
+        table = None
+        if period != None:
+            ticks = [period] + list(range(1, period))
+            table = _make_table(xys[0, ticks].tolist(), xys[1, ticks].tolist(), TABLE_HORIZON)
+        result.append(table)
+    return result
+                
+def _find_period(xys, max_period):
+    "the smallest p of at most max_period for which xys[:, t] == xys[:, t - p] for every t > p, or None"
+    max_period = min(max_period, (xys.shape[1] - 1) // 2)
+    ends = numpy.flatnonzero((xys[0, 2:max_period + 2] == xys[0, 1]) & (xys[1, 2:max_period + 2] == xys[1, 1]))
+    for p in (ends + 1).tolist():
+        if (xys[:, p + 1 : 2*p + 1] == xys[:, 1 : p + 1]).all() and (xys[:, p + 1:] == xys[:, 1:-p]).all():
+            return p
+    return None
+    
+def _make_table(xs, ys, horizon=math.inf):
+    try:
+        return TrajectoryTable(xs, ys, horizon)
+    except OverflowError:
+        return None     # too far out for an array('i')
+                
+def _rounded_values(string_pairs, times):
+    """an int64 array with a row of each (x, y) expression pair's rounded xs at each of times, followed 
+       by one of its ys, evaluated in one vectorized call"""
+    strings = tuple(string for pair in string_pairs for string in pair)
+    values = math_parser.VECTOR_FUNCTION_CACHE.get(strings)(numpy.array(times, dtype=float))
+    return numpy.trunc(values + 0.5).astype(numpy.int64)    # like int(x + 0.5)
+
+def trajectories(path_list, times):
+    """the rounded positions of each of the paths at each of times, the same as get_xy would give, 
+       as a list of (xs, ys) lists. With numpy, the expressions of every function path are evaluated 
+       over all the times in one vectorized call."""
+    times = list(times)
+    result = [None] * len(path_list)
+    funct_paths = [i for (i, path) in enumerate(path_list) if path.is_funct_path()]
+    if numpy != None and len(funct_paths) > 0 and len(times) > 0:
+        rounded = _rounded_values([path_list[i].path_strings for i in funct_paths], times).tolist()
+        for (row, i) in enumerate(funct_paths):
+            result[i] = (rounded[2*row], rounded[2*row + 1])
+    for (i, path) in enumerate(path_list):
+        if result[i] == None:
+            xys = [path.get_xy(t) for t in times]
+            result[i] = ([x for (x, _) in xys], [y for (_, y) in xys])
+    return result
+    
+def polylines(path_list, start_t=0, end_t=360, step=30):
+    "the get_polyline of each of the paths, with all the function paths' evaluated in one batch"
+    result = [None] * len(path_list)
+    funct_paths = [i for (i, path) in enumerate(path_list) if path.is_funct_path()]
+    xys = trajectories([path_list[i] for i in funct_paths], range(start_t, end_t, step))
+    for (i, (xs, ys)) in zip(funct_paths, xys):
+        result[i] = list(zip(xs, ys))
+    for (i, path) in enumerate(path_list):
+        if result[i] == None:
+            result[i] = path.get_polyline(start_t, end_t, step)
+    return result
+
 def from_json(json_data):
     if json_data["type"] == "pointpath":
         return PointPath(
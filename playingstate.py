@@ -12,6 +12,7 @@ import blocks, actors
 import drawing
 import levels
 import collisions
+import activation
 import options
 import utilities
 import timer
@@ -64,6 +65,7 @@ class InGameState(GameState):
             PAUSE:          lambda: None,
             SHOW_GRID:      lambda: self.settings.set_show_grid(not self.settings.show_grid()),
             TOGGLE_3D:      lambda: self.settings.set_draw_3d(not self.settings.draw_3d()),
+            TOGGLE_COLLISION_BACKEND: lambda: self.settings.set_collision_backend("python" if self.settings.collision_backend() == "numpy" else "numpy"),
             FREEZE_MODE:    lambda: self.settings.set_frozen_mode(not self.settings.frozen_mode()) if self.settings.edit_mode() else None
         })
     
@@ -110,8 +112,11 @@ class PlayingState(InGameState):
         
         self.death_countdown = 0
         
-        self.pusher = collisions.CollisionFixer()
+        self.collision_backend = settings.collision_backend()
+        self.pusher = collisions.create_collision_fixer(self.collision_backend)
         self.rf_fixer = collisions.ReferenceFrameFixer()
+        self.sleep_fixer = collisions.SleepFixer()
+        self.scheduler = activation.ActivationScheduler(sleep_fixer=self.sleep_fixer)
         
         self.full_reset() # starts game from scratch
         
@@ -119,6 +124,8 @@ class PlayingState(InGameState):
         InGameState.switching_to(self, prev_state_id)
         if prev_state_id != GameStateManager.EDITING_STATE:
             self.full_reset()
+        else:   # the level may have been edited around sleeping boxes
+            self.sleep_fixer.wake_all(self.get_entities(), self.get_current_level().sleep_grid)
         
     def configure_keybindings(self):
         InGameState.configure_keybindings(self)
@@ -192,16 +199,46 @@ class PlayingState(InGameState):
         timer.end("updating player")
         
         timer.start("updating everything", "update")
-        for item in self.get_entities():
-            if item is not self.get_player():
-                item.update(dt)
+        entities = self.get_entities()
+        active = entities.active()
+        timer.count("skipped updates", len(entities) - len(active))
+        if self.settings.activation_regions():
+            (scheduled, deferred) = self.scheduler.schedule(self.get_current_level(), active, self.get_player(), dt)
+            timer.count("deferred updates", deferred)
+        else:
+            scheduled = [(item, dt) for item in active]
+        awake = []
+        for (item, item_dt) in scheduled:
+            if item is not self.get_player() and not item.is_sleeping:
+                awake.append((item, item_dt))
+        for (item, item_dt) in awake:
+            item.update_before_physics(item_dt)
+        bodies = {}     # dt -> the bodies to integrate with it, which differ for far away entities catching up
+        for (item, item_dt) in awake:
+            if item.uses_physics():
+                bodies.setdefault(item_dt, []).append(item)
+        for (item_dt, group) in bodies.items():
+            blocks.PHYSICS.integrate(group, item_dt)
+        for (item, item_dt) in awake:
+            item.update_after_physics(item_dt)
         timer.end("updating everything")
         
         timer.start("collisions", "update")
-        self.pusher.solve_collisions(self.get_entities())
-        self.rf_fixer.solve_rfs(self.get_entities())
+        if self.collision_backend != self.settings.collision_backend():
+            self.collision_backend = self.settings.collision_backend()
+            self.pusher = collisions.create_collision_fixer(self.collision_backend)
+        self.pusher.continuous = self.settings.continuous_collisions()
+        level = self.get_current_level()
+        self.pusher.solve_collisions(self.get_entities(), level.collision_grid, level.static_index, level.rf_parents, level.static_occupancy)
+        self.rf_fixer.solve_rfs(self.get_entities(), level.rf_parents)
+        if dt > 0:  # nothing comes to rest in frozen mode
+            self.sleep_fixer.solve_sleeping(self.get_entities(), level.sleep_grid)
         timer.end("collisions")
         
+        timer.start("particles", "update")
+        level.particles.update(dt, level.static_occupancy)
+        timer.end("particles")
+        
         dead = self.platformer_instance.current_level().bring_out_yer_dead()
         for x in dead:
             if x.is_actor() and x is not self.get_player():
@@ -223,10 +260,10 @@ class PlayingState(InGameState):
     def add_blood(self, entity, lifespan=100):
         color = entity.color
         num = 10
+        emitter = self.get_current_level().particles
         for _ in range(0, num):
             v = ((0.5 - random.random())*10, (0.5 - random.random())*10)
-            blood = actors.Particle(entity.x(), entity.y(), 10, v, color, lifespan)
-            self.get_current_level().add_object(blood)
+            emitter.emit(entity.x(), entity.y(), v, color, lifespan)
     
     def reset_level(self, reset_player=True, death_increment=0, reset_ghost=True):
         self.death_count += death_increment
@@ -294,9 +331,10 @@ class PlayingState(InGameState):
         xoffset = (screen.get_width() - standard_width) / 2
         yoffset = (screen.get_height() - standard_height) / 2
         
+        dirty_rects = self.get_drawer().dirty_rects
         if screen.get_width() > standard_width or screen.get_height() > standard_height:
             # so that in dev mode you can see what the actual screen size would be.
-            pygame.draw.rect(screen,(255,0,0), pygame.Rect(xoffset,yoffset,standard_width,standard_height), 1)
+            dirty_rects.mark(pygame.draw.rect(screen,(255,0,0), pygame.Rect(xoffset,yoffset,standard_width,standard_height), 1))
         
         level_text = self.font.render("Level: "+str(self.get_level_num() + 1), True, (255, 255, 255))
         level_title = self.font.render(str(self.get_level_manager().current_level.name), True, (255, 255, 255))
@@ -311,14 +349,14 @@ class PlayingState(InGameState):
         level_time_text_color = self.get_time_display_color(self.level_time, best_level_time)
         level_time_text = self.font.render("Level: "+utilities.format_time(self.level_time), True, level_time_text_color)
         
-        screen.blit(level_text, (xoffset, yoffset))
-        screen.blit(level_title, (xoffset, yoffset + text_height))
+        dirty_rects.mark(screen.blit(level_text, (xoffset, yoffset)))
+        dirty_rects.mark(screen.blit(level_title, (xoffset, yoffset + text_height)))
         if self.settings.single_level_mode():
-            screen.blit(level_time_text, (xoffset + standard_width/2 - level_time_text.get_width()/2, yoffset))
+            dirty_rects.mark(screen.blit(level_time_text, (xoffset + standard_width/2 - level_time_text.get_width()/2, yoffset)))
         else:
-            screen.blit(total_time_text, (xoffset + standard_width/2 - total_time_text.get_width()/2, yoffset))
-            screen.blit(level_time_text, (xoffset + standard_width/2 - level_time_text.get_width()/2, yoffset + text_height))
-            screen.blit(death_text, (xoffset + standard_width - death_text.get_width(), yoffset))
+            dirty_rects.mark(screen.blit(total_time_text, (xoffset + standard_width/2 - total_time_text.get_width()/2, yoffset)))
+            dirty_rects.mark(screen.blit(level_time_text, (xoffset + standard_width/2 - level_time_text.get_width()/2, yoffset + text_height)))
+            dirty_rects.mark(screen.blit(death_text, (xoffset + standard_width - death_text.get_width(), yoffset)))
             
     def get_time_display_color(self, current_time, best_time, start_color=(0, 255, 0), end_color=(255, 255, 100), fail_color=(255, 0, 0)):
         if best_time == None:
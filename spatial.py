@@ -0,0 +1,355 @@
+class SpatialHash:
+    """Uniform grid broadphase. Every object is binned into each cell its rect
+       overlaps, so looking up what's near a rect only touches the cells that
+       rect covers instead of every object in the level."""
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        self._cells = {}    # (cell_x, cell_y) -> set of objects overlapping that cell
+        self._ranges = {}   # object -> (x1, y1, x2, y2), the inclusive range of cells it's binned in
+
+    def cell_range(self, rect):
+        "returns the inclusive range of cells (x1, y1, x2, y2) that rect overlaps"
+        size = self.cell_size
+        return (rect.x // size,
+                rect.y // size,
+                (rect.x + max(rect.width, 1) - 1) // size,
+                (rect.y + max(rect.height, 1) - 1) // size)
+
+    def insert(self, obj, bounds=None):
+        "bins obj in every cell its rect, or bounds if given, overlaps"
+        if obj in self._ranges:
+            self.remove(obj)
+        cell_range = self.cell_range(obj.rect if bounds == None else bounds)
+        self._ranges[obj] = cell_range
+        x1, y1, x2, y2 = cell_range
+        for cell_x in range(x1, x2 + 1):
+            for cell_y in range(y1, y2 + 1):
+                key = (cell_x, cell_y)
+                if key not in self._cells:
+                    self._cells[key] = set()
+                self._cells[key].add(obj)
+
+    def remove(self, obj):
+        if obj not in self._ranges:
+            return
+        x1, y1, x2, y2 = self._ranges.pop(obj)
+        for cell_x in range(x1, x2 + 1):
+            for cell_y in range(y1, y2 + 1):
+                key = (cell_x, cell_y)
+                cell = self._cells[key]
+                cell.discard(obj)
+                if len(cell) == 0:
+                    del self._cells[key]
+
+    def update(self, obj, predict=None):
+        """Re-bins obj if it has crossed a cell boundary since it was last binned
+           (or inserts it if it isn't in the grid yet). Returns True if it was re-binned.
+           If predict is given, obj is only re-binned once it's left the cells it's binned
+           in, and then it's binned by the rect predict() returns, which should cover
+           where it's going next. Being binned in a few extra cells just makes queries
+           return it a bit early, since they only promise what may overlap."""
+        cell_range = self.cell_range(obj.rect)
+        binned = self._ranges.get(obj)
+        if binned == cell_range:
+            return False
+        if predict != None:
+            if binned != None and binned[0] <= cell_range[0] and binned[1] <= cell_range[1] and \
+                    cell_range[2] <= binned[2] and cell_range[3] <= binned[3]:
+                return False
+            self.insert(obj, predict())
+        else:
+            self.insert(obj)
+        return True
+
+    def query(self, rect):
+        "returns the set of objects sharing at least one cell with rect"
+        result = set()
+        x1, y1, x2, y2 = self.cell_range(rect)
+        cells = self._cells
+        for cell_x in range(x1, x2 + 1):
+            for cell_y in range(y1, y2 + 1):
+                key = (cell_x, cell_y)
+                if key in cells:
+                    result.update(cells[key])
+        return result
+
+    def clear(self):
+        self._cells.clear()
+        self._ranges.clear()
+
+    def __contains__(self, obj):
+        return obj in self._ranges
+
+    def __len__(self):
+        return len(self._ranges)
+
+
+class AABBTree:
+    """Bounding volume hierarchy over objects that don't move, such as a level's static 
+       blocks. The tree is bulk built by splitting the objects at the median of their 
+       longest axis. Inserting or removing objects (which only the editor does) just 
+       flags the tree to be rebuilt on the next query."""
+    LEAF_SIZE = 4
+    
+    def __init__(self, objects=()):
+        self._objects = list(objects)
+        self._root = None
+        self._dirty = True
+        self._min_extent = 0
+        
+    def insert(self, obj):
+        self._objects.append(obj)
+        self._dirty = True
+        
+    def remove(self, obj):
+        if obj in self._objects:
+            self._objects.remove(obj)
+            self._dirty = True
+            
+    def mark_dirty(self):
+        "Must be called when an object in the tree has been moved or resized."
+        self._dirty = True
+        
+    def rebuild(self):
+        items = [(obj.rect.x, obj.rect.y, obj.rect.right, obj.rect.bottom, obj) for obj in self._objects]
+        self._root = self._build(items) if len(items) > 0 else None
+        self._min_extent = min([min(item[2] - item[0], item[3] - item[1]) for item in items]) if len(items) > 0 else 0
+        self._dirty = False
+        
+    def _build(self, items):
+        "nodes are lists of [x1, y1, x2, y2, children, leaf_items]"
+        x1 = min(item[0] for item in items)
+        y1 = min(item[1] for item in items)
+        x2 = max(item[2] for item in items)
+        y2 = max(item[3] for item in items)
+        if len(items) <= AABBTree.LEAF_SIZE:
+            return [x1, y1, x2, y2, None, items]
+        
+        if x2 - x1 >= y2 - y1:
+            items.sort(key=lambda item: item[0] + item[2])
+        else:
+            items.sort(key=lambda item: item[1] + item[3])
+        mid = len(items) // 2
+        return [x1, y1, x2, y2, (self._build(items[:mid]), self._build(items[mid:])), None]
+        
+    def query(self, rect):
+        "returns the objects whose rects overlap rect, in no particular order"
+        return self._search(rect.x, rect.y, rect.right, rect.bottom)
+        
+    def min_extent(self):
+        "the width or height of the thinnest object in the tree, nothing moving slower than this can pass through one"
+        if self._dirty:
+            self.rebuild()
+        return self._min_extent
+        
+    def query_point(self, x, y):
+        "returns the objects whose rects contain the point (x, y)"
+        x = int(x)
+        y = int(y)
+        return self._search(x, y, x + 1, y + 1)
+        
+    def _search(self, x1, y1, x2, y2):
+        if self._dirty:
+            self.rebuild()
+        result = []
+        if self._root is None or x1 >= x2 or y1 >= y2:
+            return result
+        stack = [self._root]
+        while len(stack) > 0:
+            node = stack.pop()
+            if node[0] >= x2 or x1 >= node[2] or node[1] >= y2 or y1 >= node[3]:
+                continue
+            if node[4] is None:
+                for item in node[5]:
+                    if not (item[0] >= x2 or x1 >= item[2] or item[1] >= y2 or y1 >= item[3]):
+                        result.append(item[4])
+            else:
+                stack.extend(node[4])
+        return result
+        
+    def __contains__(self, obj):
+        return obj in self._objects
+        
+    def __len__(self):
+        return len(self._objects)
+
+
+class SweepAndPrune:
+    """Sort and sweep broadphase along the x axis. The objects are kept sorted by their left 
+       edge between frames and the order is fixed up with an insertion sort, which is close 
+       to linear because nothing moves far in a single frame."""
+    def __init__(self):
+        self._objects = []      # sorted by rect.x as of the last call to find_pairs
+        self._members = set()
+        
+    def sync(self, objects):
+        "makes the set of tracked objects match objects"
+        current = set(objects)
+        if len(current) != len(self._members) or current != self._members:
+            self._objects = [x for x in self._objects if x in current]
+            self._objects.extend([x for x in objects if x not in self._members])
+            self._members = current
+            
+    def find_pairs(self, can_pair=None):
+        """returns a list of (a, b) pairs of tracked objects whose rects overlap. If can_pair is given, 
+           pairs for which can_pair(a, b) is False are skipped before their rects are compared."""
+        objects = self._objects
+        for i in range(1, len(objects)):   # insertion sort, objects are nearly sorted already
+            obj = objects[i]
+            x = obj.rect.x
+            j = i - 1
+            while j >= 0 and objects[j].rect.x > x:
+                objects[j + 1] = objects[j]
+                j -= 1
+            objects[j + 1] = obj
+            
+        pairs = []
+        active = []
+        for obj in objects:
+            rect = obj.rect
+            left = rect.x
+            active = [x for x in active if x.rect.right > left]
+            for other in active:
+                if can_pair != None and not can_pair(other, obj):
+                    continue
+                other_rect = other.rect
+                if other_rect.y < rect.bottom and rect.y < other_rect.bottom:
+                    pairs.append((other, obj))
+            active.append(obj)
+        return pairs
+        
+    def clear(self):
+        self._objects = []
+        self._members = set()
+        
+    def __len__(self):
+        return len(self._objects)
+
+
+class OccupancyMap:
+    """Tile resolution bitmap of the space covered by objects that don't move, such as a level's 
+       solid static blocks. Each tile is empty, full, or partly covered, and queries that touch 
+       partly covered tiles are refined against the rects of the objects in those tiles, so the 
+       answers are exact to the pixel. If group_key is given, objects are split into a separate 
+       bitmap per group_key(obj) and queries can be limited to some of the groups. Like AABBTree, 
+       changing the objects just flags the map to be rebuilt on the next query."""
+    EMPTY = 0
+    PARTIAL = 1
+    FULL = 2
+    
+    def __init__(self, objects=(), tile_size=16, group_key=None):
+        self.tile_size = tile_size
+        self.group_key = group_key
+        self._objects = list(objects)
+        self._layers = {}   # group -> (tile_x, tile_y, cols, rows, tiles, partial tiles)
+        self._dirty = True
+        
+    def insert(self, obj):
+        self._objects.append(obj)
+        self._dirty = True
+        
+    def remove(self, obj):
+        if obj in self._objects:
+            self._objects.remove(obj)
+            self._dirty = True
+            
+    def mark_dirty(self):
+        "Must be called when an object in the map has been moved or resized."
+        self._dirty = True
+        
+    def rebuild(self):
+        groups = {}
+        for obj in self._objects:
+            key = self.group_key(obj) if self.group_key != None else None
+            rect = obj.rect
+            if rect.width > 0 and rect.height > 0:
+                groups.setdefault(key, []).append((rect.x, rect.y, rect.right, rect.bottom))
+        self._layers = {key: self._build(rects) for (key, rects) in groups.items()}
+        self._dirty = False
+        
+    def _build(self, rects):
+        size = self.tile_size
+        tile_x = min(r[0] for r in rects) // size
+        tile_y = min(r[1] for r in rects) // size
+        cols = (max(r[2] for r in rects) - 1) // size - tile_x + 1
+        rows = (max(r[3] for r in rects) - 1) // size - tile_y + 1
+        tiles = bytearray(cols * rows)
+        partial = {}    # tile index -> rects partly covering that tile
+        for r in rects:
+            x1, y1, x2, y2 = r
+            for ty in range(y1 // size, (y2 - 1) // size + 1):
+                for tx in range(x1 // size, (x2 - 1) // size + 1):
+                    i = (ty - tile_y) * cols + tx - tile_x
+                    if tiles[i] == OccupancyMap.FULL:
+                        continue
+                    if x1 <= tx * size and y1 <= ty * size and x2 >= (tx + 1) * size and y2 >= (ty + 1) * size:
+                        tiles[i] = OccupancyMap.FULL
+                        partial.pop(i, None)
+                    else:
+                        tiles[i] = OccupancyMap.PARTIAL
+                        partial.setdefault(i, []).append(r)
+        return (tile_x, tile_y, cols, rows, tiles, partial)
+        
+    def groups(self):
+        if self._dirty:
+            self.rebuild()
+        return list(self._layers.keys())
+        
+    def tiles(self, group=None):
+        """returns (tile_x, tile_y, cols, rows, tiles) for group, where tiles is a row major bytearray 
+           of EMPTY, PARTIAL and FULL. Returns None if nothing is in the group."""
+        if self._dirty:
+            self.rebuild()
+        if group not in self._layers:
+            return None
+        return self._layers[group][:5]
+        
+    def occupied(self, x, y, groups=None):
+        "whether the pixel (x, y) is covered"
+        return self._search(x, y, x + 1, y + 1, groups)
+        
+    def row_span(self, y, x1, x2, groups=None):
+        "whether any pixel in row y from x1 up to (but not including) x2 is covered"
+        return self._search(x1, y, x2, y + 1, groups)
+        
+    def column_span(self, x, y1, y2, groups=None):
+        "whether any pixel in column x from y1 up to (but not including) y2 is covered"
+        return self._search(x, y1, x + 1, y2, groups)
+        
+    def overlaps(self, x1, y1, x2, y2, groups=None):
+        "whether any pixel from (x1, y1) up to (but not including) (x2, y2) is covered"
+        return self._search(x1, y1, x2, y2, groups)
+        
+    def _search(self, x1, y1, x2, y2, groups):
+        if self._dirty:
+            self.rebuild()
+        if x1 >= x2 or y1 >= y2:
+            return False
+        if groups is None:
+            groups = self._layers.keys()
+        size = self.tile_size
+        for key in groups:
+            if key not in self._layers:
+                continue
+            tile_x, tile_y, cols, rows, tiles, partial = self._layers[key]
+            tx1 = max(x1 // size - tile_x, 0)
+            tx2 = min((x2 - 1) // size - tile_x, cols - 1)
+            ty1 = max(y1 // size - tile_y, 0)
+            ty2 = min((y2 - 1) // size - tile_y, rows - 1)
+            for ty in range(ty1, ty2 + 1):
+                row = ty * cols
+                for tx in range(tx1, tx2 + 1):
+                    state = tiles[row + tx]
+                    if state == OccupancyMap.FULL:
+                        return True
+                    elif state == OccupancyMap.PARTIAL:
+                        for r in partial[row + tx]:
+                            if r[0] < x2 and x1 < r[2] and r[1] < y2 and y1 < r[3]:
+                                return True
+        return False
+        
+    def __contains__(self, obj):
+        return obj in self._objects
+        
+    def __len__(self):
+        return len(self._objects)
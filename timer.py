@@ -6,6 +6,7 @@ _START_TIMES = {}
 _TOTAL_TIMES = {}
 _GROUPS = {}
 _PARENTS = {}       # mapping from event to their groups
+_COUNTS = {}        # counter name -> total
 
 def start(event_name, group_name=None):
     _START_TIMES[event_name] = _current_time_millis()
@@ -28,6 +29,12 @@ def end(event_name):
     _TOTAL_TIMES[event_name] += elapsed_time
     _START_TIMES[event_name] = -1
     
+def count(counter_name, amount=1):
+    _COUNTS[counter_name] = _COUNTS.get(counter_name, 0) + amount
+    
+def event_count(counter_name):
+    return _COUNTS.get(counter_name, 0)
+    
 def all_events():
     return _TOTAL_TIMES.keys()
     
@@ -45,6 +52,7 @@ def clear():
     _START_TIMES.clear()
     _PARENTS.clear()
     _GROUPS.clear()
+    _COUNTS.clear()
     
 def has_events():
     return len(_TOTAL_TIMES) > 0
@@ -65,6 +73,8 @@ def get_text_summary():
         for child in sorted(_GROUPS[group], key=lambda x: -event_time(x)):
             child_time = event_time(child)
             lines.append("\t" + utilities.extend_to(child + ": ", 30)  + _percent_str(child_time, group_total_time) + "\t" + str(child_time))
+    for counter in sorted(_COUNTS.keys()):
+        lines.append(utilities.extend_to(counter + ": ", 30) + str(_COUNTS[counter]))
             
     return "\n".join(lines)
         